@@ -1,21 +1,20 @@
+import fcntl
+import os
 import sqlite3
 import logging
-import os
+import db
+from db import get_db
+from analytics_handler import ensure_runtime_schema
+from auth import ensure_attempts_schema
+from history import ensure_history_schema
+from inventory import ensure_inventory_schema
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+MIGRATE_LOCK_FILE = os.path.join(os.path.dirname(db.DB_FILE), 'airaware.migrate.lock')
 
-def init_database():
-    try:
-        conn = sqlite3.connect('airaware.db')
-        cursor = conn.cursor()
-        
-        logging.info("Creating database tables...")
-        
-        # Create tables with improved schema
-        cursor.execute('''
+
+def _create_core_tables(conn):
+    with conn:
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS rooms (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             room_name TEXT UNIQUE NOT NULL,
@@ -25,15 +24,15 @@ def init_database():
         )
         ''')
 
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             username TEXT PRIMARY KEY,
             password TEXT NOT NULL,
             role TEXT NOT NULL
         )
         ''')
-        
-        cursor.execute('''
+
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS fans (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             pin INTEGER UNIQUE NOT NULL,
@@ -43,8 +42,8 @@ def init_database():
             FOREIGN KEY (room_id) REFERENCES rooms(id)
         )
         ''')
-        
-        cursor.execute('''
+
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS fan_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             fan_id INTEGER,
@@ -56,11 +55,70 @@ def init_database():
         )
         ''')
 
-        # Commit changes and close
-        conn.commit()
-        conn.close()
-        logging.info("Database initialized successfully!")
-        
+
+def _create_fan_assignments(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fan_assignments (
+                room TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                pin INTEGER NOT NULL,
+                manual INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(fan_assignments)')}
+        if 'manual' not in columns:
+            # Manual override is shared state once several processes serve requests
+            conn.execute('ALTER TABLE fan_assignments ADD COLUMN manual INTEGER NOT NULL DEFAULT 0')
+
+
+def _add_runtime_totals(conn):
+    # Adds the day index and per-room running totals to fan_runtime_daily
+    # databases that were migrated before they existed
+    ensure_runtime_schema(conn)
+
+
+# Schema migrations, applied in order. PRAGMA user_version stores how many of
+# them a database has had, so a current database costs one PRAGMA read at
+# startup. Append new steps, never reorder them. Databases from before
+# user_version was used are at 0 and already have some of these tables, so
+# every step must be safe to run on a database that has its changes.
+MIGRATIONS = [
+    _create_core_tables,
+    _create_fan_assignments,
+    ensure_runtime_schema,
+    ensure_inventory_schema,
+    ensure_history_schema,
+    ensure_attempts_schema,
+    _add_runtime_totals,
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def init_database():
+    """Create or upgrade the database schema to the latest version.
+
+    Safe to call from several processes at once: they take turns on
+    MIGRATE_LOCK_FILE, and whoever comes second finds nothing left to do.
+    """
+    try:
+        conn = get_db()
+        if schema_version(conn) < len(MIGRATIONS):
+            fd = os.open(MIGRATE_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                version = schema_version(conn)
+                for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                    logging.info(f"Migrating database to schema version {number} ({migration.__name__})...")
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {number}')
+            finally:
+                os.close(fd)
+            logging.info("Database initialized successfully!")
+        db.schema_current.set()
     except sqlite3.Error as e:
         logging.error(f"SQLite error: {e}")
         raise
@@ -69,4 +127,8 @@ def init_database():
         raise
 
 if __name__ == '__main__':
-    init_database()
\ No newline at end of file
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    init_database()
@@ -1,131 +1,305 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import sqlite3
 import logging
+import json
+import threading
+import time
+from db import get_db, schema_current
+from metrics import DB_QUERY_SECONDS, timed
 
-DB_FILE = 'airaware.db'
+ANALYTICS_CACHE_TTL = 10  # seconds, matches the analytics page refresh interval
 
-def get_db():
-    """Establish a connection to the database."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+_schema_ready = False
+_analytics_cache = None  # (expires_at, payload)
+_analytics_generation = 0  # bumped by invalidate_analytics()
+_analytics_lock = threading.Lock()
 
-def load_runtime_log():
-    """Load the runtime log from the database."""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Ensure the table exists
-        cursor.execute('''
+def ensure_runtime_schema(conn):
+    """Create the runtime log, interval and rollup tables with their indexes, and backfill them."""
+    global _schema_ready
+    if _schema_ready or schema_current.is_set():
+        return
+    with conn:
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS fan_runtime_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 room TEXT NOT NULL,
                 action TEXT NOT NULL,
-                timestamp TEXT NOT NULL
+                timestamp TEXT NOT NULL,
+                ts INTEGER
             )
         ''')
-        
-        cursor.execute('SELECT room, action, timestamp FROM fan_runtime_log')
-        rows = cursor.fetchall()
-        
-        runtime_log = {}
-        for row in rows:
-            if row['room'] not in runtime_log:
-                runtime_log[row['room']] = []
-            runtime_log[row['room']].append({
-                'action': row['action'],
-                'timestamp': datetime.fromisoformat(row['timestamp'])
-            })
-        
-        conn.close()
-        return runtime_log
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(fan_runtime_log)')}
+        if 'ts' not in columns:
+            logging.info("Adding epoch timestamps to fan_runtime_log...")
+            conn.execute('ALTER TABLE fan_runtime_log ADD COLUMN ts INTEGER')
+        # ISO timestamps were written in local time, so convert them in Python
+        rows = conn.execute('SELECT id, timestamp FROM fan_runtime_log WHERE ts IS NULL').fetchall()
+        conn.executemany(
+            'UPDATE fan_runtime_log SET ts = ? WHERE id = ?',
+            [(int(datetime.fromisoformat(row['timestamp']).timestamp()), row['id']) for row in rows]
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_fan_runtime_log_room_ts ON fan_runtime_log (room, ts)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_fan_runtime_log_ts ON fan_runtime_log (ts)')
+
+        backfill = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fan_runtime_intervals'"
+        ).fetchone() is None
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fan_runtime_intervals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room TEXT NOT NULL,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER,
+                duration INTEGER
+            )
+        ''')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_fan_runtime_intervals_room_start '
+            'ON fan_runtime_intervals (room, start_ts)'
+        )
+        # At most one open (still running) interval per room
+        conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_fan_runtime_intervals_open '
+            'ON fan_runtime_intervals (room) WHERE end_ts IS NULL'
+        )
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fan_runtime_daily (
+                room TEXT NOT NULL,
+                day TEXT NOT NULL,
+                seconds INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room, day)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_fan_runtime_daily_day ON fan_runtime_daily (day)')
+        # Running total per room, kept next to the daily rollups
+        totals_missing = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fan_runtime_totals'"
+        ).fetchone() is None
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fan_runtime_totals (
+                room TEXT PRIMARY KEY,
+                seconds INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        if totals_missing:
+            conn.execute(
+                'INSERT INTO fan_runtime_totals (room, seconds) '
+                'SELECT room, SUM(seconds) FROM fan_runtime_daily GROUP BY room'
+            )
+    _schema_ready = True
+    if backfill:
+        rebuild_runtime_intervals()
+
+@timed(DB_QUERY_SECONDS, call_site='load_runtime_intervals')
+def load_runtime_intervals(room, start, end, min_gap=0):
+    """Return [[start_ts, end_ts], ...] fan-on intervals for a room, clipped to [start, end).
+
+    Intervals separated by less than min_gap seconds are merged. A fan that is
+    still on gets an interval ending at min(now, end).
+    """
+    open_end = min(int(time.time()), end)
+    try:
+        conn = get_db()
+        ensure_runtime_schema(conn)
+        rows = conn.execute(
+            '''SELECT start_ts, COALESCE(end_ts, ?) FROM fan_runtime_intervals
+               WHERE room = ? AND start_ts < ? AND (end_ts IS NULL OR end_ts > ?)
+               ORDER BY start_ts''',
+            (open_end, room, end, start)
+        ).fetchall()
     except sqlite3.Error as e:
         logging.error(f"Database error: {e}")
-        return {}
+        return []
 
-def log_fan_action(room, action):
-    """Log a fan action (ON/OFF) in the database."""
+    intervals = []
+    for interval_start, interval_end in rows:
+        interval_start, interval_end = max(interval_start, start), min(interval_end, end)
+        if interval_end <= interval_start:
+            continue
+        if intervals and interval_start - intervals[-1][1] < min_gap:
+            intervals[-1][1] = max(intervals[-1][1], interval_end)
+        else:
+            intervals.append([interval_start, interval_end])
+    return intervals
+
+def _add_daily_runtime(conn, room, start_ts, end_ts):
+    """Add an interval to the per-room daily rollups, split at local midnight, and to the room's total."""
+    conn.execute(
+        '''INSERT INTO fan_runtime_totals (room, seconds) VALUES (?, ?)
+           ON CONFLICT(room) DO UPDATE SET seconds = seconds + excluded.seconds''',
+        (room, end_ts - start_ts)
+    )
+    rollups = []
+    while start_ts < end_ts:
+        day = datetime.fromtimestamp(start_ts).date()
+        next_midnight = int(datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp())
+        part_end = min(end_ts, next_midnight)
+        rollups.append((room, day.isoformat(), part_end - start_ts))
+        start_ts = part_end
+    conn.executemany(
+        '''INSERT INTO fan_runtime_daily (room, day, seconds) VALUES (?, ?, ?)
+           ON CONFLICT(room, day) DO UPDATE SET seconds = seconds + excluded.seconds''',
+        rollups
+    )
+
+def _apply_fan_action(conn, room, action, ts):
+    """Open or close the room's runtime interval for one ON/OFF event."""
+    if action == 'ON':
+        # A repeated ON restarts the open interval, matching how the log is paired
+        conn.execute(
+            '''INSERT INTO fan_runtime_intervals (room, start_ts) VALUES (?, ?)
+               ON CONFLICT(room) WHERE end_ts IS NULL DO UPDATE SET start_ts = excluded.start_ts''',
+            (room, ts)
+        )
+    elif action == 'OFF':
+        row = conn.execute(
+            'SELECT id, start_ts FROM fan_runtime_intervals WHERE room = ? AND end_ts IS NULL',
+            (room,)
+        ).fetchone()
+        if row is not None:
+            end_ts = max(ts, row['start_ts'])
+            conn.execute(
+                'UPDATE fan_runtime_intervals SET end_ts = ?, duration = ? WHERE id = ?',
+                (end_ts, end_ts - row['start_ts'], row['id'])
+            )
+            _add_daily_runtime(conn, room, row['start_ts'], end_ts)
+
+@timed(DB_QUERY_SECONDS, call_site='log_fan_actions')
+def log_fan_actions(actions, now=None):
+    """Log several fan actions as (room, action) pairs in one transaction."""
+    actions = list(actions)
+    if not actions:
+        return
+    now = datetime.fromtimestamp(now) if now is not None else datetime.now()
+    ts = int(now.timestamp())
     try:
         conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO fan_runtime_log (room, action, timestamp) VALUES (?, ?, ?)',
-            (room, action, datetime.now().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        ensure_runtime_schema(conn)
+        with conn:
+            conn.executemany(
+                'INSERT INTO fan_runtime_log (room, action, timestamp, ts) VALUES (?, ?, ?, ?)',
+                [(room, action, now.isoformat(), ts) for room, action in actions]
+            )
+            for room, action in actions:
+                _apply_fan_action(conn, room, action, ts)
     except sqlite3.Error as e:
         logging.error(f"Error logging fan action: {e}")
         raise
+    invalidate_analytics()
 
-def calculate_runtime_today(fan):
-    """Calculate the total runtime of a fan for today."""
-    runtime_log = load_runtime_log()
-    if fan['room'] not in runtime_log:
-        return 0
-    
-    today = datetime.now().date()
-    events = runtime_log[fan['room']]
-    total_runtime = 0
-    last_on = None
-    
-    for event in events:
-        if event['timestamp'].date() != today:
-            continue
-            
-        if event['action'] == 'ON':
-            last_on = event['timestamp']
-        elif event['action'] == 'OFF' and last_on:
-            runtime = (event['timestamp'] - last_on).total_seconds() / 3600
-            total_runtime += runtime
-            last_on = None
-    
-    if last_on and fan['status'] == 'ON':
-        current_runtime = (datetime.now() - last_on).total_seconds() / 3600
-        total_runtime += current_runtime
-    
-    return round(total_runtime, 1)
+def log_fan_action(room, action):
+    """Log a fan action (ON/OFF) in the database."""
+    log_fan_actions([(room, action)])
 
-def calculate_total_runtime():
-    """Calculate the total runtime of all fans."""
-    runtime_log = load_runtime_log()
-    total_hours = 0
-    
-    for room_events in runtime_log.values():
-        last_on = None
-        for event in room_events:
-            if event['action'] == 'ON':
-                last_on = event['timestamp']
-            elif event['action'] == 'OFF' and last_on:
-                runtime = (event['timestamp'] - last_on).total_seconds() / 3600
-                total_hours += runtime
-                last_on = None
-    
-    return round(total_hours, 1)
+def rebuild_runtime_intervals():
+    """Rebuild fan_runtime_intervals and fan_runtime_daily from fan_runtime_log."""
+    conn = get_db()
+    ensure_runtime_schema(conn)
+    logging.info("Rebuilding fan runtime intervals...")
+    with conn:
+        conn.execute('DELETE FROM fan_runtime_intervals')
+        conn.execute('DELETE FROM fan_runtime_daily')
+        conn.execute('DELETE FROM fan_runtime_totals')
+        events = conn.execute('SELECT room, action, ts FROM fan_runtime_log ORDER BY room, ts, id')
+        count = 0
+        for row in events:
+            _apply_fan_action(conn, row['room'], row['action'], row['ts'])
+            count += 1
+    logging.info(f"Rebuilt runtime intervals from {count} log entries.")
 
-def get_last_active(fan):
-    """Get the last active time of a fan."""
-    runtime_log = load_runtime_log()
-    if fan['room'] not in runtime_log:
-        return 'Never'
-    
-    events = runtime_log[fan['room']]
-    if not events:
+def _format_last_active(last_ts, status):
+    """Format a last-event epoch as 'Never', 'Current' or a relative age."""
+    if last_ts is None:
         return 'Never'
     
-    last_event = max(events, key=lambda x: x['timestamp'])
-    
-    if fan['status'] == 'ON':
+    if status == 'ON':
         return 'Current'
     
-    delta = datetime.now() - last_event['timestamp']
+    delta = datetime.now() - datetime.fromtimestamp(last_ts)
     if delta.days > 0:
         return f"{delta.days}d ago"
     if delta.seconds // 3600 > 0:
         return f"{delta.seconds // 3600}h ago"
     return f"{delta.seconds // 60}m ago"
 
+@timed(DB_QUERY_SECONDS, call_site='load_runtime_summary')
+def load_runtime_summary(rooms):
+    """Load today's runtime, open interval start and last event for many rooms at once."""
+    now = datetime.now()
+    summary = {room: {'today': 0, 'open_start': None, 'last_ts': None} for room in rooms}
+    conn = get_db()
+    ensure_runtime_schema(conn)
+    for row in conn.execute(
+        'SELECT room, seconds FROM fan_runtime_daily WHERE day = ?', (now.date().isoformat(),)
+    ):
+        if row['room'] in summary:
+            summary[row['room']]['today'] = row['seconds']
+    for row in conn.execute('SELECT room, start_ts FROM fan_runtime_intervals WHERE end_ts IS NULL'):
+        if row['room'] in summary:
+            summary[row['room']]['open_start'] = row['start_ts']
+    # One statement, one (room, ts) index probe per room
+    for row in conn.execute(
+        '''SELECT value AS room,
+                  (SELECT MAX(ts) FROM fan_runtime_log WHERE room = value) AS last_ts
+           FROM json_each(?)''',
+        (json.dumps(list(summary)),)
+    ):
+        summary[row['room']]['last_ts'] = row['last_ts']
+    total = conn.execute('SELECT COALESCE(SUM(seconds), 0) AS seconds FROM fan_runtime_totals').fetchone()
+    return summary, total['seconds']
+
+def _compute_analytics(room_data, fans):
+    """Build the /api/analytics payload from a single load of the runtime tables."""
+    now = datetime.now()
+    midnight = int(now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    co2_lookup = {room['roomGroupName']: room.get('co2', 0) for room in room_data}
+    summary, total_seconds = load_runtime_summary([fan['room'] for fan in fans])
+
+    fan_rows = []
+    for fan in fans:
+        runtime = summary[fan['room']]
+        seconds = runtime['today']
+        if fan['status'] == 'ON' and runtime['open_start'] is not None:
+            seconds += max(0, int(now.timestamp()) - max(runtime['open_start'], midnight))
+        fan_rows.append({
+            'room': fan['room'],
+            'status': fan['status'],
+            'runtimeToday': round(seconds / 3600, 1),
+            'lastActive': _format_last_active(runtime['last_ts'], fan['status']),
+            'co2Reduced': calculate_co2_reduction(co2_lookup.get(fan['room'], 0), fan),
+        })
+
+    return {
+        'totalRuntime': round(total_seconds / 3600, 1),
+        'activeFans': sum(1 for fan in fans if fan['status'] == 'ON'),
+        'efficiency': calculate_efficiency(room_data, fans),
+        'fans': fan_rows,
+    }
+
+def get_analytics(room_data, fans):
+    """Return analytics for all fans, computed at most once per ANALYTICS_CACHE_TTL."""
+    global _analytics_cache
+    with _analytics_lock:
+        if _analytics_cache is not None and time.monotonic() < _analytics_cache[0]:
+            return _analytics_cache[1]
+        generation = _analytics_generation
+        try:
+            analytics = _compute_analytics(room_data, fans)
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
+            return {'totalRuntime': 0, 'activeFans': 0, 'efficiency': 0, 'fans': []}
+        # Don't cache a result that a fan action logged meanwhile has made stale
+        if generation == _analytics_generation:
+            _analytics_cache = (time.monotonic() + ANALYTICS_CACHE_TTL, analytics)
+        return analytics
+
+def invalidate_analytics():
+    """Drop the cached analytics so the next request recomputes them."""
+    global _analytics_cache, _analytics_generation
+    _analytics_generation += 1
+    _analytics_cache = None
+
 def calculate_efficiency(room_data, fan_data):
     """Calculate the efficiency of fan usage."""
     if not fan_data:
@@ -146,4 +320,12 @@ def calculate_co2_reduction(current_co2, fan):
         target_co2 = 800  # Target CO2 level in ppm
         reduction = max(0, current_co2 - target_co2)
         return round(reduction)
-    return 0
\ No newline at end of file
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['rebuild']:
+        logging.basicConfig(level=logging.INFO)
+        rebuild_runtime_intervals()
+    else:
+        print(f"Usage: {sys.argv[0]} rebuild")
@@ -1,35 +1,266 @@
-import requests
+import threading
 import time
 import logging
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, wait
+import events
+from metrics import UPSTREAM_ERRORS, UPSTREAM_FETCH_SECONDS
+from config import CO2_API_URL, BUILDING_ID, BUILDING_IDS, HEADERS
 
-_cached_room_data = None
-_last_fetch = 0
 _CACHE_DURATION = 10  
+_CACHE_TTLS = {}  # building_id -> seconds, for buildings that need a different TTL
+_MAX_CACHED_BUILDINGS = 32
+_REFRESH_WORKERS = 4
+_REQUEST_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+_FIRST_FETCH_TIMEOUT = 15
 
-def fetch_room_data_cached(building_id="512"):
-    global _cached_room_data, _last_fetch
-    current_time = time.time()
-    if _cached_room_data is None or (current_time - _last_fetch) > _CACHE_DURATION:
-        url = "https://co2.mesh.lv/api/device/list"
-        payload = {
-            "buildingId": building_id,
-            "captchaToken": None
-        }
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'Mozilla/5.0 (X11; CrOS x86_64 14541.0.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36',
-        }
-        response = requests.post(url, json=payload, headers=headers)
-        logging.info(f"Response Status Code: {response.status_code}")
-        if response.status_code == 200:
-            try:
-                _cached_room_data = response.json()
-            except ValueError as e:
-                logging.error(f"JSON decoding error: {e}")
-                _cached_room_data = []
-        else:
+_session = None
+_executor = ThreadPoolExecutor(max_workers=_REFRESH_WORKERS, thread_name_prefix='co2-refresh')
+
+# building_id -> _CacheEntry, least recently used first
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+cache_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0}
+_snapshot_arrived = threading.Condition()  # notified whenever any building gets a new snapshot
+_snapshot_listeners = []
+
+
+class RoomSnapshot:
+    """Immutable, pre-indexed view of one building's room data.
+
+    Built once per successful fetch so request handlers can look rooms up by
+    name or device id in constant time instead of scanning the raw list.
+    """
+    __slots__ = ('rooms', 'by_name', 'by_device_id', 'co2_by_name', 'version', 'fetched_at')
+
+    def __init__(self, room_data, version=0, fetched_at=0):
+        rooms = sorted(
+            (MappingProxyType(dict(room)) for room in room_data if room.get('roomGroupName') is not None),
+            key=lambda room: room['roomGroupName']
+        )
+        self.rooms = tuple(rooms)
+        self.by_name = MappingProxyType({room['roomGroupName']: room for room in rooms})
+        self.by_device_id = MappingProxyType({room['id']: room for room in rooms if room.get('id') is not None})
+        self.co2_by_name = MappingProxyType({name: room.get('co2', 0) for name, room in self.by_name.items()})
+        self.fetched_at = fetched_at
+        self.version = version  # assigned last: RoomSnapshot is frozen from here on
+
+    def __setattr__(self, name, value):
+        if hasattr(self, 'version'):
+            raise AttributeError("RoomSnapshot is immutable")
+        object.__setattr__(self, name, value)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def co2(self, room_name, default=0):
+        """Return a room's CO2 level, or default if the room is unknown."""
+        return self.co2_by_name.get(room_name, default)
+
+    def device_id(self, room_name):
+        """Return the sensor device id for a room, or None."""
+        room = self.by_name.get(room_name)
+        return room.get('id') if room is not None else None
+
+    def available_rooms(self, assigned_rooms):
+        """Return the rooms (sorted by name) that are not in assigned_rooms."""
+        return [room for room in self.rooms if room['roomGroupName'] not in assigned_rooms]
+
+
+_EMPTY_SNAPSHOT = RoomSnapshot([])
+
+
+class _CacheEntry:
+    """Last good room snapshot for one building."""
+    __slots__ = ('snapshot', 'fetched_at', 'ttl', 'refreshing', 'ready')
+
+    def __init__(self, ttl):
+        self.snapshot = None
+        self.fetched_at = 0
+        self.ttl = ttl
+        self.refreshing = False  # a fetch for this building is in flight
+        self.ready = threading.Event()  # set once the first fetch finished
+
+
+def _get_session():
+    """Return the shared keep-alive session used for upstream requests."""
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=_REFRESH_WORKERS)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session.headers.update(HEADERS)
+    return _session
+
+def _fetch_room_data(building_id):
+    """Fetch room data from the CO2 API. Returns None on any failure."""
+    payload = {
+        "buildingId": building_id,
+        "captchaToken": None
+    }
+    import requests  # loaded on the first fetch: it is a good part of the app's import time
+    with UPSTREAM_FETCH_SECONDS.time(building=building_id):
+        try:
+            response = _get_session().post(CO2_API_URL, json=payload, timeout=_REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            logging.error(f"Request to CO2 API failed for building {building_id}: {e}")
+            reason = 'timeout' if isinstance(e, requests.Timeout) else 'connection'
+            UPSTREAM_ERRORS.inc(building=building_id, reason=reason)
+            return None
+        logging.debug(f"Response Status Code: {response.status_code}")
+        if response.status_code != 200:
             logging.error(f"Request failed with status code {response.status_code}")
-            _cached_room_data = []
-        _last_fetch = current_time
-    return _cached_room_data
\ No newline at end of file
+            UPSTREAM_ERRORS.inc(building=building_id, reason='status')
+            return None
+        try:
+            return response.json()
+        except ValueError as e:
+            logging.error(f"JSON decoding error: {e}")
+            UPSTREAM_ERRORS.inc(building=building_id, reason='json')
+            return None
+
+def _get_entry(building_id):
+    """Return the cache entry for a building, creating it and evicting the LRU one if needed."""
+    with _cache_lock:
+        entry = _cache.get(building_id)
+        if entry is not None:
+            _cache.move_to_end(building_id)
+            return entry
+        entry = _CacheEntry(_CACHE_TTLS.get(building_id, _CACHE_DURATION))
+        _cache[building_id] = entry
+        while len(_cache) > _MAX_CACHED_BUILDINGS:
+            evicted, _ = _cache.popitem(last=False)
+            cache_stats['evictions'] += 1
+            logging.info(f"Evicted CO2 data for building {evicted} from cache")
+        return entry
+
+def _publish_co2_changes(building_id, previous, snapshot):
+    """Publish the rooms whose CO2 level differs between two snapshots."""
+    changed = [
+        {'roomGroupName': name, 'co2': co2}
+        for name, co2 in snapshot.co2_by_name.items()
+        if previous.co2_by_name.get(name) != co2
+    ]
+    if changed:
+        events.publish('co2', {'building': building_id, 'rooms': changed})
+
+def publish_snapshot(building_id, data, fetched_at=None):
+    """Install freshly fetched room data for a building as its new snapshot.
+
+    This is how any fetcher (the refresh thread pool or the asyncio pipeline)
+    hands data to readers. Returns the new RoomSnapshot.
+    """
+    fetched_at = fetched_at if fetched_at is not None else time.time()
+    entry = _get_entry(building_id)
+    previous = entry.snapshot or _EMPTY_SNAPSHOT
+    snapshot = RoomSnapshot(data, version=previous.version + 1, fetched_at=fetched_at)
+    entry.snapshot = snapshot
+    entry.fetched_at = fetched_at
+    entry.ready.set()
+    _publish_co2_changes(building_id, previous, snapshot)
+    with _snapshot_arrived:
+        _snapshot_arrived.notify_all()
+    for listener in _snapshot_listeners:
+        try:
+            listener(building_id, snapshot)
+        except Exception as e:
+            logging.error(f"Error in snapshot listener: {e}")
+    return snapshot
+
+def add_snapshot_listener(listener):
+    """Call listener(building_id, snapshot) for every new snapshot. Listeners must not block."""
+    _snapshot_listeners.append(listener)
+
+def start_refresh(building_id):
+    """Claim the refresh of a building's data, so only one fetch for it runs at a time.
+
+    Returns the building's cache entry, or None if a refresh is already in
+    flight. Every claim must be followed by finish_refresh().
+    """
+    entry = _get_entry(building_id)
+    with _cache_lock:
+        if entry.refreshing:
+            return None
+        entry.refreshing = True
+    return entry
+
+def finish_refresh(building_id, entry, data):
+    """Install fetched data (None if the fetch failed) and release the claim.
+
+    On failure the last good data is kept. Returns the new RoomSnapshot or None.
+    """
+    try:
+        if data is not None:
+            return publish_snapshot(building_id, data)
+        # Also stamp failures, so a down upstream is retried once per TTL, not per request
+        entry.fetched_at = time.time()
+        return None
+    finally:
+        entry.refreshing = False
+        entry.ready.set()
+
+def refresh_room_data(building_id=BUILDING_ID):
+    """Fetch fresh room data for a building unless a fetch is already in flight.
+
+    On failure the last good data is kept. Returns True if this call did the fetch.
+    """
+    entry = start_refresh(building_id)
+    if entry is None:
+        return False
+    data = None
+    try:
+        data = _fetch_room_data(building_id)
+    finally:
+        finish_refresh(building_id, entry, data)
+    return True
+
+def prefetch_room_data(building_ids=BUILDING_IDS):
+    """Start fetching room data for the buildings in the thread pool, e.g. while the app starts."""
+    return [_executor.submit(refresh_room_data, building_id) for building_id in building_ids]
+
+def _count(stat):
+    # Request threads and refresh threads both count, so += needs the lock
+    with _cache_lock:
+        cache_stats[stat] += 1
+
+def get_room_snapshot(building_id=BUILDING_ID):
+    """Return the last good RoomSnapshot for a building without waiting on the network.
+
+    Stale data is returned as-is while a refresh runs in the thread pool. Only
+    the first call for a building, before any data exists, waits for a fetch.
+    """
+    entry = _get_entry(building_id)
+    if entry.snapshot is None and not entry.ready.is_set():
+        _count('misses')
+        if not refresh_room_data(building_id):
+            entry.ready.wait(_FIRST_FETCH_TIMEOUT)
+    elif time.time() - entry.fetched_at > entry.ttl:
+        _count('stale_hits')
+        if not entry.refreshing:
+            _executor.submit(refresh_room_data, building_id)
+    else:
+        _count('hits')
+    return entry.snapshot or _EMPTY_SNAPSHOT
+
+def wait_for_snapshot(building_id=BUILDING_ID, after_version=0, timeout=None):
+    """Block until a building has a snapshot newer than after_version.
+
+    Returns the snapshot, or None if timeout seconds pass first.
+    """
+    entry = _get_entry(building_id)
+    with _snapshot_arrived:
+        _snapshot_arrived.wait_for(
+            lambda: entry.snapshot is not None and entry.snapshot.version > after_version,
+            timeout
+        )
+    snapshot = entry.snapshot
+    return snapshot if snapshot is not None and snapshot.version > after_version else None
+
+def background_refresher(building_ids=BUILDING_IDS):
+    """Background thread that refreshes every building concurrently every _CACHE_DURATION seconds."""
+    while True:
+        wait([_executor.submit(refresh_room_data, building_id) for building_id in building_ids])
+        time.sleep(_CACHE_DURATION)
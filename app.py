@@ -1,34 +1,33 @@
 import logging
 import threading
 import os
-from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify, g
-import sqlite3
-from api_handler import fetch_room_data_cached
-from hardware import turn_fan_on, turn_fan_off, initialize_fan
+import queue
+import time
+from flask import Flask, Response, render_template, redirect, url_for, request, flash, session, jsonify, g, json
+import db
+import metrics
+from airaware import init_database
+from locks import room_locks
+import events
+import service
+from service import apply_fan_state, apply_fan_states
+from api_handler import get_room_snapshot, prefetch_room_data, cache_stats
+from config import BUILDING_ID
 from auth import auth
-from fan_handler import load_fan_assignments, save_fan_assignments, AVAILABLE_FAN_PINS
-from automation import automation_worker, manual_control
-
-logging.basicConfig(level=logging.WARNING)
-logging.getLogger('werkzeug').setLevel(logging.WARNING)
-logging.getLogger('urllib3').setLevel(logging.WARNING)
+from fan_handler import (
+    init_fan_registry, get_fans, get_fan, get_assigned_rooms, get_registry_version, assign_fan, unregister_fan,
+    set_fan_status, apply_fan_changes, update_fan_co2
+)
+from inventory import pin_allocator
+from analytics_handler import get_analytics, load_runtime_intervals
+from history import load_co2_history
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 app.secret_key = 'your_secret_key'
 app.register_blueprint(auth)
-DB_FILE = os.path.abspath('airaware.db') 
-if not os.path.exists(DB_FILE):
-    from airaware import init_database
-    init_database()
-
-if not os.access(DB_FILE, os.W_OK):
-    logging.error(f"Database file {DB_FILE} is not writable!")
-    raise PermissionError(f"Database file {DB_FILE} is not writable!")
-
-fan_assignments = load_fan_assignments()
-used_pins = {fan["pin"] for fan in fan_assignments}
-automation_in_progress = {}
-fan_lock = threading.Lock()
+DB_FILE = db.DB_FILE
+_app_lock = threading.Lock()
+_app_ready = False
 
 # CO2 Thresholds and Messages
 CO2_HIGH_THRESHOLD = 1500
@@ -36,11 +35,102 @@ CO2_VERY_HIGH_THRESHOLD = 2000
 CO2_HIGH_MESSAGE = "CO2 levels are high ({:.0f} ppm).  Ventilation is recommended."
 CO2_VERY_HIGH_MESSAGE = "CO2 levels are VERY HIGH ({:.0f} ppm)! Immediate ventilation is strongly advised."
 
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_REFRESH_SECONDS = 5  # below the CO2 cache TTL, so streams see every refresh
+# Versions are per process, so ETags carry a process token: under gunicorn a
+# poll answered by another worker gets a full response, never a wrong 304.
+_PROCESS_TOKEN = f"{os.getpid():x}{int(time.time() * 1000):x}"
+_body_cache = {}  # endpoint -> (etag, serialized body)
+HISTORY_DEFAULT_RANGE = 24 * 3600
+HISTORY_DEFAULT_POINTS = 300
+HISTORY_MAX_POINTS = 2000
+BULK_OPERATIONS = ('assign', 'on', 'off', 'remove')
+MAX_BULK_OPERATIONS = 200
+
+def configure_logging(level=logging.WARNING):
+    """Set up logging for a server process. Called by the entry points, not on import."""
+    logging.basicConfig(level=level)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+def create_app():
+    """Prepare the database, fan registry and background services, and return the app.
+
+    Call this once per process, after any fork: under gunicorn every worker
+    calls it, and exactly one of them becomes the leader that drives the GPIO
+    pins and runs automation (see service.py). Don't use gunicorn's --preload.
+    """
+    global _app_ready
+    with _app_lock:
+        if _app_ready:
+            return app
+        if os.path.exists(DB_FILE) and not os.access(DB_FILE, os.W_OK):
+            logging.error(f"Database file {DB_FILE} is not writable!")
+            raise PermissionError(f"Database file {DB_FILE} is not writable!")
+
+        # Fetch CO2 data in the background while the schema and fan registry
+        # load, so the first dashboard doesn't have to wait for the upstream API
+        prefetch_room_data()
+        init_database()
+        init_fan_registry()
+        pin_allocator.reconcile()
+        service.start(room_locks)
+        _app_ready = True
+    return app
+
 @app.teardown_appcontext
 def close_db(error):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    db.release_db()
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by route pattern, not path, so /graph/<room> stays one series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, route=route, method=request.method, status=response.status_code
+        )
+    return response
+
+def _collect_app_metrics():
+    lookups = cache_stats['hits'] + cache_stats['stale_hits'] + cache_stats['misses']
+    lock_stats = room_locks.stats()
+    return [
+        ('airaware_co2_cache_lookups_total', 'counter', "CO2 snapshot cache lookups, by result.",
+         [({'result': result}, cache_stats[result]) for result in ('hits', 'stale_hits', 'misses')]),
+        ('airaware_co2_cache_evictions_total', 'counter', "Buildings evicted from the CO2 snapshot cache.",
+         [({}, cache_stats['evictions'])]),
+        ('airaware_co2_cache_hit_ratio', 'gauge', "Share of CO2 snapshot lookups served from cache, stale included.",
+         [({}, (cache_stats['hits'] + cache_stats['stale_hits']) / lookups if lookups else 0.0)]),
+        ('airaware_room_lock_acquisitions_total', 'counter', "Room lock acquisitions.",
+         [({}, lock_stats['acquisitions'])]),
+        ('airaware_room_lock_contended_total', 'counter', "Room lock acquisitions that had to wait.",
+         [({}, lock_stats['contended'])]),
+        ('airaware_room_lock_hold_seconds_total', 'counter', "Total time room locks were held.",
+         [({}, lock_stats['hold_seconds'])]),
+        ('airaware_room_lock_max_hold_seconds', 'gauge', "Longest time a room lock was held.",
+         [({}, lock_stats['max_hold_seconds'])]),
+        ('airaware_fans', 'gauge', "Registered fans, by status.",
+         [({'status': status}, sum(fan['status'] == status for fan in get_fans())) for status in ('ON', 'OFF')]),
+        ('airaware_free_fan_pins', 'gauge', "Device pins with no fan assigned, as this process sees them.",
+         [({}, pin_allocator.free_count())]),
+        ('airaware_event_subscribers', 'gauge', "Open /api/stream connections.",
+         [({}, events.subscriber_count())]),
+        ('airaware_leader', 'gauge', "1 if this process drives the GPIO pins and automation.",
+         [({}, int(service.is_leader()))]),
+    ]
+
+metrics.register_collector(_collect_app_metrics)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this process."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
@@ -60,24 +150,208 @@ def settings():
 def alerts():
     return render_template("alerts.html")
 
+def _versioned_json(endpoint, version, last_modified, build):
+    """Return build()'s JSON tagged with version, or 304 if the client already has it.
+
+    The serialized body is cached until the version changes, so repeat polls
+    neither rebuild nor re-serialize it. Read the version before the data.
+    """
+    etag = f"{endpoint}-{_PROCESS_TOKEN}-{version}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        cached = _body_cache.get(endpoint)
+        if cached is None or cached[0] != etag:
+            cached = _body_cache[endpoint] = (etag, json.dumps(build()).encode())
+        response = Response(cached[1], mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True  # always revalidate
+    return response
+
 @app.route('/api/available_rooms')
 def available_rooms():
-    room_data = fetch_room_data_cached()
-    assigned_rooms = {fan['room'] for fan in fan_assignments}
-    available = [room['roomGroupName'] for room in room_data if room['roomGroupName'] not in assigned_rooms]
-    return jsonify(available)
+    snapshot = get_room_snapshot()
+    fans_version, fans_changed = get_registry_version()
+    return _versioned_json(
+        'rooms', f"{snapshot.version}.{snapshot.fetched_at!r}.{fans_version}",
+        max(snapshot.fetched_at or 0, fans_changed),
+        lambda: [room['roomGroupName'] for room in snapshot.available_rooms(get_assigned_rooms())]
+    )
 
 @app.route('/api/get_co2_levels')
 def get_co2_levels():
-    room_data = fetch_room_data_cached()
-    co2_levels = [{"roomGroupName": room["roomGroupName"], "co2": room.get("co2", 0)} for room in room_data]
-    return jsonify(co2_levels)
+    snapshot = get_room_snapshot()
+    return _versioned_json(
+        'co2', f"{snapshot.version}.{snapshot.fetched_at!r}", snapshot.fetched_at or 0,
+        lambda: [{"roomGroupName": name, "co2": co2} for name, co2 in snapshot.co2_by_name.items()]
+    )
 
 @app.route('/api/fan_status')
 def fan_status():
-    global fan_assignments
-    fan_assignments = load_fan_assignments()
-    return jsonify(fan_assignments)
+    version, changed_at = get_registry_version()
+    return _versioned_json('fans', version, changed_at, get_fans)
+
+@app.route('/api/stream')
+def stream():
+    """Server-Sent Events stream of fan and CO2 changes for the dashboard."""
+    # Subscribe before taking the initial state so no change falls in between
+    subscription = events.subscribe()
+    snapshot = get_room_snapshot()
+
+    def generate():
+        try:
+            yield events.format_sse('fans', get_fans())
+            yield events.format_sse('co2', {
+                'building': BUILDING_ID,
+                'rooms': [{'roomGroupName': name, 'co2': co2} for name, co2 in snapshot.co2_by_name.items()]
+            })
+            last_sent = time.monotonic()
+            while True:
+                # Only the leader runs the background refresher. Asking for the
+                # snapshot starts a refresh once it is stale, so streams served
+                # by other workers get co2 events too.
+                get_room_snapshot()
+                try:
+                    message = subscription.get(timeout=STREAM_REFRESH_SECONDS)
+                except queue.Empty:
+                    if time.monotonic() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+                        last_sent = time.monotonic()
+                        yield ": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                last_sent = time.monotonic()
+                yield message
+        finally:
+            events.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/analytics')
+def analytics():
+    return jsonify(get_analytics(get_room_snapshot().rooms, get_fans()))
+
+@app.route('/api/history/<room>')
+def room_history(room):
+    """CO2 readings and fan-on intervals for a room, downsampled to ?points= points.
+
+    Takes ?start= and ?end= as epoch seconds (default: the last 24 hours).
+    """
+    now = int(time.time())
+    try:
+        end = int(request.args.get('end', now))
+        start = int(request.args.get('start', end - HISTORY_DEFAULT_RANGE))
+        points = int(request.args.get('points', HISTORY_DEFAULT_POINTS))
+    except ValueError:
+        return jsonify({'error': "start, end and points must be integers."}), 400
+    if start >= end:
+        return jsonify({'error': "start must be before end."}), 400
+    points = min(max(points, 2), HISTORY_MAX_POINTS)
+
+    resolution, co2 = load_co2_history(room, start, end, points)
+    response = jsonify({
+        'room': room,
+        'start': start,
+        'end': end,
+        'resolution': resolution,
+        'co2': co2,
+        'fan_intervals': load_runtime_intervals(room, start, end, min_gap=resolution),
+    })
+    response.add_etag()
+    # Ranges that ended a while ago won't change any more
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600 if end < now - 3600 else 10
+    return response.make_conditional(request)
+
+@app.route('/api/fans/bulk', methods=['POST'])
+def bulk_fan_operations():
+    """Apply a list of fan operations in one go.
+
+    Takes {"operations": [{"op": "assign"|"on"|"off"|"remove", "room": ...}, ...]}
+    and returns one result per operation, in order. Invalid operations are
+    reported and skipped; the rest are saved in one transaction and then
+    switched in one hardware pass. An item whose change was saved but whose
+    relay failed to switch has success set and an actuation_error.
+    """
+    if 'user' not in session:
+        return jsonify({'success': False, 'error': "Please log in."}), 401
+    payload = request.get_json(silent=True)
+    operations = payload.get('operations') if isinstance(payload, dict) else payload
+    if not isinstance(operations, list):
+        return jsonify({'success': False, 'error': "Expected a list of operations."}), 400
+    if len(operations) > MAX_BULK_OPERATIONS:
+        return jsonify({'success': False, 'error': f"At most {MAX_BULK_OPERATIONS} operations per request."}), 400
+
+    results = []
+    valid = {}
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        room = operation.get('room') if isinstance(operation, dict) else None
+        results.append({'op': op, 'room': room, 'success': False})
+        if op not in BULK_OPERATIONS:
+            results[index]['error'] = f"Unknown operation {op!r}."
+        elif not isinstance(room, str) or not room:
+            results[index]['error'] = "Missing room."
+        elif room in valid:
+            results[index]['error'] = "Room appears more than once."
+        else:
+            valid[room] = index
+
+    with room_locks.hold(*valid):
+        assigns, statuses, removes, pin_states = [], {}, {}, {}
+        for room, index in valid.items():
+            op = results[index]['op']
+            fan = get_fan(room)
+            if op == 'assign':
+                if fan is not None:
+                    results[index]['error'] = "Fan is already assigned to this room."
+                else:
+                    assigns.append(room)
+            elif fan is None:
+                results[index]['error'] = "Fan not found"
+            elif op == 'remove':
+                removes[room] = fan['pin']
+                if fan['status'] == 'ON':
+                    pin_states[fan['pin']] = False
+            else:
+                statuses[room] = ('ON', True) if op == 'on' else ('OFF', False)
+                pin_states[fan['pin']] = op == 'on'
+
+        rooms = assigns + list(statuses) + list(removes)
+        try:
+            fans = apply_fan_changes(assigns, statuses, removes)
+        except Exception as e:
+            # Nothing was saved: the transaction rolled back
+            logging.error(f"Error applying bulk fan operations: {e}")
+            for room in rooms:
+                results[valid[room]]['error'] = str(e)
+            return jsonify({'success': False, 'results': results}), 500
+        for room in assigns:
+            if fans[room] is not None:
+                # Initialize new fans with OFF state explicitly
+                pin_states[fans[room]['pin']] = False
+        # The changes are saved by now. A relay that fails to switch is
+        # reported on its item; the leader's reconcile keeps retrying it.
+        failed_pins = apply_fan_states(pin_states)
+        for room in rooms:
+            result = results[valid[room]]
+            if room in assigns and fans[room] is None:
+                result['error'] = "No available fans left."
+                continue
+            result['success'] = True
+            if fans[room] is not None:
+                result['fan'] = fans[room]
+            pin = fans[room]['pin'] if fans[room] is not None else removes.get(room)
+            if pin in failed_pins:
+                logging.error(f"Error switching fan in {room} (pin {pin}): {failed_pins[pin]}")
+                result['actuation_error'] = str(failed_pins[pin])
+
+    success = all(result['success'] and 'actuation_error' not in result for result in results)
+    return jsonify({'success': success, 'results': results})
 
 @app.route('/graph/<room>')
 def room_graph(room):
@@ -85,14 +359,19 @@ def room_graph(room):
         flash("Please log in to view the graph.", "warning")
         return redirect(url_for('auth.login'))
 
-    room_data = fetch_room_data_cached()
-    device_id = next((r.get('id') for r in room_data if r.get('roomGroupName') == room), None)
-    if not device_id:
-        flash("No graph available for this room.", "warning")
-        return redirect(url_for('dashboard'))
-    
-    graph_url = f"https://co2.mesh.lv/home/device-charts/{device_id}"
-    return render_template("graph.html", graph_url=graph_url, room=room)
+    return render_template("graph.html", room=room)
+
+def _switch_saved_fan(pin, on, response):
+    """Switch a fan whose change is already saved, reporting a relay failure on the response.
+
+    The saved state stands either way; the leader's reconcile keeps retrying the relay.
+    """
+    try:
+        apply_fan_state(pin, on)
+    except Exception as e:
+        logging.error(f"Error switching fan at pin {pin}: {e}")
+        response['actuation_error'] = str(e)
+    return response
 
 @app.route('/dashboard', methods=['GET', 'POST'])
 def dashboard():
@@ -100,110 +379,90 @@ def dashboard():
         flash("Please log in to access the dashboard.", "warning")
         return redirect(url_for('auth.login'))
 
-    global fan_assignments
-    fan_assignments = load_fan_assignments()
-
     if request.method == 'POST':
         room_name = request.form.get('room')
         if 'assign_fan' in request.form:
-            if any(fan['room'] == room_name for fan in fan_assignments):
-                return jsonify({'success': False, 'error': "Fan is already assigned to this room."})
-            
-            available_pin = next((p for p in AVAILABLE_FAN_PINS if p not in used_pins), None)
-            if available_pin is None:
-                return jsonify({'success': False, 'error': "No available fans left."})
+            with room_locks.hold(room_name):
+                if get_fan(room_name) is not None:
+                    return jsonify({'success': False, 'error': "Fan is already assigned to this room."})
             
-            try:
-                used_pins.add(available_pin)
+                try:
+                    new_fan = assign_fan(room_name)
+                    if new_fan is None:
+                        return jsonify({'success': False, 'error': "No available fans left."})
+                except Exception as e:
+                    return jsonify({'success': False, 'error': str(e)})
                 # Initialize fan with OFF state explicitly
-                initialize_fan(available_pin) # Initialize the fan
-                turn_fan_off(available_pin) # Set the fan to off explicitly
-                new_fan = {'room': room_name, 'status': 'OFF', 'pin': available_pin}
-                fan_assignments.append(new_fan)
-                save_fan_assignments(fan_assignments)
-                
-                return jsonify({
-                    'success': True, 
-                    'message': f"Fan assigned to {room_name}.", 
+                return jsonify(_switch_saved_fan(new_fan["pin"], False, {
+                    'success': True,
+                    'message': f"Fan assigned to {room_name}.",
                     'fan': new_fan
-                })
-            except Exception as e:
-                return jsonify({'success': False, 'error': str(e)})
+                }))
 
         elif 'fan_control' in request.form:
             action = request.form.get('fan_control')
             try:
-                with fan_lock:
-                    for fan in fan_assignments:
-                        if fan['room'] == room_name:
-                            if action == 'on':
-                                turn_fan_on(fan["pin"])
-                                fan['status'] = 'ON'
-                                manual_control[room_name] = True
-                            elif action == 'off':
-                                turn_fan_off(fan["pin"])
-                                fan['status'] = 'OFF'
-                                manual_control.pop(room_name, None)
-
-                                # Check CO2 level and set session notification
-                                room_data = fetch_room_data_cached()
-                                room_co2 = next((room.get('co2', 0) for room in room_data if room['roomGroupName'] == room_name), 0)
-                                if room_co2 >= CO2_VERY_HIGH_THRESHOLD:
-                                    session['notification'] = {
-                                        'type': 'warning',
-                                        'message': CO2_VERY_HIGH_MESSAGE.format(room_co2),
-                                        'room': room_name
-                                    }
-                                elif room_co2 >= CO2_HIGH_THRESHOLD:
-                                    session['notification'] = {
-                                        'type': 'info',
-                                        'message': CO2_HIGH_MESSAGE.format(room_co2),
-                                        'room': room_name
-                                    }
-                            save_fan_assignments(fan_assignments)
-                            return jsonify({"success": True, "status": fan['status']})
-                    return jsonify({"success": False, "error": "Fan not found"})
+                with room_locks.hold(room_name):
+                    fan = get_fan(room_name)
+                    if fan is None:
+                        return jsonify({"success": False, "error": "Fan not found"})
+                    response = {"success": True}
+                    if action == 'on':
+                        fan = set_fan_status(room_name, 'ON', manual=True)
+                        _switch_saved_fan(fan["pin"], True, response)
+                    elif action == 'off':
+                        fan = set_fan_status(room_name, 'OFF', manual=False)
+                        _switch_saved_fan(fan["pin"], False, response)
+
+                        # Check CO2 level and set session notification
+                        room_co2 = get_room_snapshot().co2(room_name)
+                        if room_co2 >= CO2_VERY_HIGH_THRESHOLD:
+                            session['notification'] = {
+                                'type': 'warning',
+                                'message': CO2_VERY_HIGH_MESSAGE.format(room_co2),
+                                'room': room_name
+                            }
+                        elif room_co2 >= CO2_HIGH_THRESHOLD:
+                            session['notification'] = {
+                                'type': 'info',
+                                'message': CO2_HIGH_MESSAGE.format(room_co2),
+                                'room': room_name
+                            }
+                    response['status'] = fan['status']
+                    return jsonify(response)
             except Exception as e:
                 logging.error(f"Error controlling fan: {e}")
                 return jsonify({"success": False, "error": str(e)}), 500
 
         elif 'remove_fan' in request.form:
             try:
-                with fan_lock:
-                    fan_to_remove = next((fan for fan in fan_assignments if fan['room'] == room_name), None)
+                with room_locks.hold(room_name):
+                    fan_to_remove = get_fan(room_name)
                     if fan_to_remove:
-                        if fan_to_remove['status'] == 'ON':
-                            turn_fan_off(fan_to_remove["pin"])
-                        fan_assignments.remove(fan_to_remove)
-                        used_pins.discard(fan_to_remove["pin"])
-                        save_fan_assignments(fan_assignments)
+                        unregister_fan(room_name)
                         flash(f"Fan removed from {room_name}.", "success")
-                        return jsonify({"success": True, "message": f"Fan removed from {room_name}"})
+                        response = {"success": True, "message": f"Fan removed from {room_name}"}
+                        if fan_to_remove['status'] == 'ON':
+                            _switch_saved_fan(fan_to_remove["pin"], False, response)
+                        return jsonify(response)
                     return jsonify({"success": False, "error": "Fan not found"})
             except Exception as e:
                 logging.error(f"Error removing fan: {e}")
                 return jsonify({"success": False, "error": str(e)}), 500
 
-    room_data = fetch_room_data_cached()
-    room_data.sort(key=lambda room: room['roomGroupName'])
-
-    available_rooms = [
-        room for room in room_data
-        if not any(fan['room'] == room['roomGroupName'] for fan in fan_assignments)
-    ]
+    fan_assignments = get_fans()
+    snapshot = get_room_snapshot()
+    available_rooms = snapshot.available_rooms(get_assigned_rooms())
 
     for fan in fan_assignments:
-        for room in room_data:
-            if room["roomGroupName"] == fan['room']:
-                fan['co2_level'] = room.get("co2", 0)
+        fan['co2_level'] = snapshot.co2(fan['room'])
+    update_fan_co2(snapshot.co2_by_name)
 
     # Check for notification in session
     notification = session.pop('notification', None)
 
-    return render_template('dashboard.html', rooms=available_rooms, fan_assignments=fan_assignments, room_data=room_data, notification=notification)
+    return render_template('dashboard.html', rooms=available_rooms, fan_assignments=fan_assignments, room_data=snapshot.rooms, notification=notification)
 
 if __name__ == '__main__':
-    fan_lock = threading.Lock()
-    automation_thread = threading.Thread(target=automation_worker, args=(fan_assignments, fan_lock), daemon=True)
-    automation_thread.start()
-    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=5000)
\ No newline at end of file
+    configure_logging()
+    create_app().run(debug=True, use_reloader=False, threaded=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -2,63 +2,153 @@ from flask import Blueprint, render_template, request, redirect, url_for, sessio
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import logging
+import threading
+import time
+from collections import OrderedDict
 from datetime import timedelta
 import re
+from db import get_db, schema_current
 
 auth = Blueprint('auth', __name__)
 
-DB_FILE = 'airaware.db'
-LOGIN_ATTEMPTS = {}
 MAX_LOGIN_ATTEMPTS = 5
+MAX_CLIENT_LOGIN_ATTEMPTS = 50  # per IP address, which many users may share
 LOCKOUT_TIME = 300  # Lockout time in seconds
-
-def get_db():
-    """Establish a connection to the database."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def load_users():
-    """Load all users from the database."""
+ATTEMPT_EVICTION_INTERVAL = 60
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 1024
+
+# Recently used user records: username -> (expires_at, user). Only existing
+# users are cached, so a user registered through another worker can log in
+# right away; save_user() drops the entry in this process.
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+_attempts_schema_ready = False
+_last_attempt_eviction = 0
+
+def get_user(username):
+    """Return {'password', 'role'} for a user, or None. Served from a small TTL cache."""
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_cache.get(username)
+        if cached is not None and cached[0] > now:
+            _user_cache.move_to_end(username)
+            return cached[1]
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users')
-        users = {
-            row['username']: {
-                'password': row['password'],
-                'role': row['role']
-            } for row in cursor.fetchall()
-        }
-        conn.close()
-        return users
+        row = get_db().execute('SELECT password, role FROM users WHERE username = ?', (username,)).fetchone()
     except sqlite3.Error as e:
         logging.error(f"Database error: {e}")
-        return {}
+        return None
+    if row is None:
+        return None
+    user = {'password': row['password'], 'role': row['role']}
+    with _user_cache_lock:
+        _user_cache[username] = (now + USER_CACHE_TTL, user)
+        _user_cache.move_to_end(username)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return user
+
+def invalidate_user(username):
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
 
 def save_user(username, password_hash, role='user'):
     """Save a new user to the database."""
     try:
         conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO users (username, password, role) VALUES (?, ?, ?)',
-            (username, password_hash, role)
-        )
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute(
+                'INSERT INTO users (username, password, role) VALUES (?, ?, ?)',
+                (username, password_hash, role)
+            )
     except sqlite3.Error as e:
         logging.error(f"Error saving user: {e}")
         raise
+    finally:
+        invalidate_user(username)
+
+# Failed logins are rate limited with a sliding-window counter: each key keeps
+# only the failure counts of the current and the previous LOCKOUT_TIME window,
+# and the previous count is weighted by how much of it still overlaps the
+# sliding window. The rows live in SQLite so every worker sees the same counts.
+
+def ensure_attempts_schema(conn):
+    """Create the login_attempts table."""
+    global _attempts_schema_ready
+    if _attempts_schema_ready or schema_current.is_set():
+        return
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS login_attempts (
+                key TEXT PRIMARY KEY,
+                window_start INTEGER NOT NULL,
+                prev_count INTEGER NOT NULL,
+                curr_count INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_login_attempts_window ON login_attempts (window_start)')
+    _attempts_schema_ready = True
+
+def failed_login_count(key, now=None):
+    """Estimated failed logins for key within the last LOCKOUT_TIME seconds."""
+    now = now if now is not None else time.time()
+    window = int(now // LOCKOUT_TIME * LOCKOUT_TIME)
+    conn = get_db()
+    ensure_attempts_schema(conn)
+    row = conn.execute(
+        'SELECT window_start, prev_count, curr_count FROM login_attempts WHERE key = ?', (key,)
+    ).fetchone()
+    if row is None:
+        return 0
+    if row['window_start'] == window:
+        previous, current = row['prev_count'], row['curr_count']
+    elif row['window_start'] == window - LOCKOUT_TIME:
+        previous, current = row['curr_count'], 0
+    else:
+        return 0
+    return previous * (1 - (now - window) / LOCKOUT_TIME) + current
+
+def is_locked_out(key, limit=MAX_LOGIN_ATTEMPTS, now=None):
+    return failed_login_count(key, now) >= limit
+
+def record_failed_login(*keys, now=None):
+    """Count a failed login against each key, evicting stale rows now and then."""
+    global _last_attempt_eviction
+    now = now if now is not None else time.time()
+    window = int(now // LOCKOUT_TIME * LOCKOUT_TIME)
+    conn = get_db()
+    ensure_attempts_schema(conn)
+    with conn:
+        conn.executemany(
+            '''INSERT INTO login_attempts (key, window_start, prev_count, curr_count)
+               VALUES (:key, :window, 0, 1)
+               ON CONFLICT(key) DO UPDATE SET
+                   prev_count = CASE
+                       WHEN window_start = :window THEN prev_count
+                       WHEN window_start = :window - :size THEN curr_count
+                       ELSE 0 END,
+                   curr_count = CASE WHEN window_start = :window THEN curr_count + 1 ELSE 1 END,
+                   window_start = :window''',
+            [{'key': key, 'window': window, 'size': LOCKOUT_TIME} for key in keys]
+        )
+        if now - _last_attempt_eviction > ATTEMPT_EVICTION_INTERVAL:
+            # Rows older than the previous window no longer count for anything
+            conn.execute('DELETE FROM login_attempts WHERE window_start < ?', (window - LOCKOUT_TIME,))
+            _last_attempt_eviction = now
+
+def reset_failed_logins(key):
+    conn = get_db()
+    ensure_attempts_schema(conn)
+    with conn:
+        conn.execute('DELETE FROM login_attempts WHERE key = ?', (key,))
 
 def is_strong_password(password):
     """Check if a password meets the strength requirements."""
     pattern = r'^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[@$!%*?&])[A-Za-z\d@$!%*?&]{8,}$'
     return re.match(pattern, password)
 
-# Load users into memory
-users = load_users()
-
 @auth.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -88,13 +178,12 @@ def register():
 
         try:
             # Your existing registration logic here
-            if username in users:
+            if get_user(username) is not None:
                 flash("Username already exists.", "warning")
                 return redirect(url_for('auth.register'))
             
             password_hash = generate_password_hash(password, method='sha256')
             save_user(username, password_hash)
-            users[username] = {'password': password_hash, 'role': 'user'}
 
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('auth.login'))
@@ -113,21 +202,22 @@ def login():
         password = request.form['password']
         remember = 'remember' in request.form
 
-        # Check for lockout due to too many failed attempts
-        if username in LOGIN_ATTEMPTS and LOGIN_ATTEMPTS[username]['attempts'] >= MAX_LOGIN_ATTEMPTS:
+        # Check for lockout due to too many failed attempts, per account and per client
+        user_key, client_key = f"user:{username}", f"ip:{request.remote_addr}"
+        if is_locked_out(user_key) or is_locked_out(client_key, MAX_CLIENT_LOGIN_ATTEMPTS):
             flash("Account temporarily locked due to too many failed login attempts.", "danger")
             return redirect(url_for('auth.login'))
 
         # Validate credentials
-        if username in users and check_password_hash(users[username]['password'], password):
+        user = get_user(username)
+        if user is not None and check_password_hash(user['password'], password):
             session['user'] = username
             session.permanent = remember
             flash("Login successful.", "success")
-            LOGIN_ATTEMPTS.pop(username, None)  # Reset login attempts
+            reset_failed_logins(user_key)
             return redirect(url_for('dashboard'))
         else:
-            LOGIN_ATTEMPTS.setdefault(username, {'attempts': 0})
-            LOGIN_ATTEMPTS[username]['attempts'] += 1
+            record_failed_login(user_key, client_key)
             flash("Invalid credentials.", "danger")
 
     return render_template('login.html')
@@ -1,61 +1,126 @@
 import logging
 import time
 from hardware import turn_fan_on, turn_fan_off
-from api_handler import fetch_room_data_cached  
-from fan_handler import save_fan_assignments, load_fan_assignments
+from api_handler import get_room_snapshot, wait_for_snapshot
+from fan_handler import get_fans, get_fan, set_fan_statuses, update_fan_co2
+from metrics import AUTOMATION_SWEEP_SECONDS
+from config import (
+    BUILDING_ID, AUTOMATION_ON_PPM, AUTOMATION_OFF_PPM, AUTOMATION_ROOM_THRESHOLDS,
+    AUTOMATION_MIN_RUN_SECONDS, AUTOMATION_MIN_IDLE_SECONDS
+)
 
-automation_in_progress = {}
-manual_control = {}
+SNAPSHOT_WAIT_TIMEOUT = 30  # seconds; only used to nudge a refresh if no snapshot arrives
 
-def automation_worker(fan_assignments, fan_lock):
-    """Background thread to automate fan control based on CO₂ levels."""
-    while True:
-        try:
-            # Reload fan assignments and room data on each iteration
-            current_assignments = load_fan_assignments()
-            room_data = fetch_room_data_cached()
-            
-            # Create CO2 lookup dictionary
-            co2_lookup = {
-                room['roomGroupName']: room.get('co2', 0) 
-                for room in room_data
-            }
-            
-            for fan in current_assignments:
-                room = fan['room']
-                current_co2 = co2_lookup.get(room, 0)
-                
-                # Skip if under manual control
-                if room in manual_control and manual_control[room]:
+
+class AutomationEngine:
+    """Switches fans based on CO₂ levels, each time a new room snapshot arrives.
+
+    Only rooms whose reading changed since the last evaluation (plus rooms
+    whose toggle was held back by the minimum run/idle time) are evaluated.
+    """
+
+    def __init__(self, locks, building_id=BUILDING_ID, clock=time.monotonic):
+        self.locks = locks
+        self.building_id = building_id
+        self.clock = clock
+        self.version = 0
+        self.last_co2 = {}  # room -> CO2 level at its last evaluation
+        self.last_toggle = {}  # room -> clock() of the last automated toggle
+        self.deferred = set()  # rooms held back by a minimum run/idle time
+        # Settings from config.py, per engine so simulation.py can try others
+        self.default_thresholds = (AUTOMATION_ON_PPM, AUTOMATION_OFF_PPM)
+        self.room_thresholds = AUTOMATION_ROOM_THRESHOLDS
+        self.min_run_seconds = AUTOMATION_MIN_RUN_SECONDS
+        self.min_idle_seconds = AUTOMATION_MIN_IDLE_SECONDS
+
+    def thresholds(self, room):
+        return self.room_thresholds.get(room, self.default_thresholds)
+
+    def run(self):
+        """Evaluate every new snapshot as it lands. Never returns."""
+        while True:
+            snapshot = wait_for_snapshot(self.building_id, self.version, SNAPSHOT_WAIT_TIMEOUT)
+            if snapshot is None:
+                get_room_snapshot(self.building_id)  # starts a refresh if the data is stale
+                continue
+            self.version = snapshot.version
+            try:
+                self.evaluate(snapshot)
+            except Exception as e:
+                logging.error(f"Error in automation engine: {e}")
+
+    def evaluate(self, snapshot):
+        """Evaluate the rooms whose readings changed and toggle their fans."""
+        with AUTOMATION_SWEEP_SECONDS.time(building=self.building_id):
+            return self._evaluate(snapshot)
+
+    def _evaluate(self, snapshot):
+        update_fan_co2(snapshot.co2_by_name)
+        now = self.clock()
+        decisions = {}
+
+        for fan in get_fans():
+            room = fan['room']
+            # Rooms of other buildings (or whose sensor dropped out) are not ours to judge
+            if room not in snapshot.co2_by_name:
+                continue
+            current_co2 = snapshot.co2(room)
+
+            # Skip if under manual control; re-evaluate once it is released
+            if fan['manual']:
+                self.last_co2.pop(room, None)
+                continue
+            if self.last_co2.get(room) == current_co2 and room not in self.deferred:
+                continue
+            self.last_co2[room] = current_co2
+            self.deferred.discard(room)
+
+            on_ppm, off_ppm = self.thresholds(room)
+            running = fan['status'] == 'ON'
+            if not running and current_co2 >= on_ppm:
+                hold = self.min_idle_seconds
+                action = 'ON'
+            elif running and current_co2 < off_ppm:
+                hold = self.min_run_seconds
+                action = 'OFF'
+            else:
+                continue
+
+            if now - self.last_toggle.get(room, float('-inf')) < hold:
+                self.deferred.add(room)
+                continue
+
+            decisions[room] = (fan, action, current_co2)
+
+        if not decisions:
+            return {}
+        status_changes = {}
+        with self.locks.hold(*decisions):
+            for room, (fan, action, current_co2) in decisions.items():
+                # A manual toggle may have landed while we were deciding
+                current = get_fan(room)
+                if current is None or current['manual'] or current['status'] == action:
                     continue
-                
-                # Only act if CO2 crosses thresholds
-                if current_co2 >= 1000:
-                    if not automation_in_progress.get(room, False):
+                try:
+                    if action == 'ON':
                         logging.info(f"CO2 high in {room}: {current_co2} ppm - Starting fan in {room}")
-                        automation_in_progress[room] = True
-                        with fan_lock:
-                            turn_fan_on(fan["pin"])
-                            # Update fan status directly in current_assignments
-                            for f in current_assignments:
-                                if f['room'] == room:
-                                    f['status'] = 'ON'
-                                    break  # Exit loop after updating the fan
-                            save_fan_assignments(current_assignments)
-                else:
-                    if automation_in_progress.get(room, False):
+                        turn_fan_on(current["pin"])
+                    else:
                         logging.info(f"CO2 normal in {room}: {current_co2} ppm - Stopping fan in {room}")
-                        automation_in_progress[room] = False
-                        with fan_lock:
-                            turn_fan_off(fan["pin"])
-                            # Update fan status directly in current_assignments
-                            for f in current_assignments:
-                                if f['room'] == room:
-                                    f['status'] = 'OFF'
-                                    break  # Exit loop after updating the fan
-                            save_fan_assignments(current_assignments)
-                
-            time.sleep(10)  # Check every 10 seconds
-        except Exception as e:
-            logging.error(f"Error in automation worker: {e}")
-            time.sleep(10)  # Wait before retrying
\ No newline at end of file
+                        turn_fan_off(current["pin"])
+                except Exception as e:
+                    # Leave the room's state alone so the next snapshot tries again
+                    logging.error(f"Error switching fan {action} in {room}: {e}")
+                    self.last_co2.pop(room, None)
+                    continue
+                self.last_toggle[room] = now
+                status_changes[room] = action
+
+            # Persist every toggle from this pass in one transaction
+            set_fan_statuses(status_changes)
+        return status_changes
+
+
+def automation_worker(locks):
+    """Background thread to automate fan control based on CO₂ levels."""
+    AutomationEngine(locks).run()
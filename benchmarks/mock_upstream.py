@@ -0,0 +1,94 @@
+"""Stand-in for the co2.mesh.lv device/list API, serving synthetic rooms.
+
+Run it on its own and point the app at it:
+
+    python benchmarks/mock_upstream.py --rooms 500 --port 8900
+    AIRAWARE_CO2_API_URL=http://127.0.0.1:8900/api/device/list python app.py
+
+or start it in-process with MockUpstream(rooms).start().
+"""
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def room_names(count):
+    return [f"R{i:04d}" for i in range(count)]
+
+
+class MockUpstream:
+    """Threaded HTTP server answering POST /api/device/list with `rooms` rooms.
+
+    Every response moves each room's CO2 level a few ppm (a random walk
+    between 400 and 2500), like real sensors do between polls. `latency`
+    adds a fixed delay per request.
+    """
+
+    def __init__(self, rooms=100, host='127.0.0.1', port=0, latency=0.0, seed=1):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.levels = {name: self.random.randint(450, 1400) for name in room_names(rooms)}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/device/list"
+
+    def payload(self):
+        with self._lock:
+            self.requests += 1
+            for name, level in self.levels.items():
+                self.levels[name] = min(2500, max(400, level + self.random.randint(-40, 40)))
+            rooms = [
+                {'id': f"dev-{name}", 'roomGroupName': name, 'co2': level}
+                for name, level in self.levels.items()
+            ]
+        return json.dumps(rooms).encode()
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if upstream.latency:
+                    threading.Event().wait(upstream.latency)
+                body = upstream.payload()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='mock-upstream', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    upstream = MockUpstream(args.rooms, args.host, args.port, args.latency)
+    print(f"Serving {args.rooms} rooms at {upstream.url}")
+    upstream.server.serve_forever()
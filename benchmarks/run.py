@@ -0,0 +1,367 @@
+"""Load tests for the app's hot paths, against a mock upstream and mock GPIO pins.
+
+    python benchmarks/run.py                        # every scenario
+    python benchmarks/run.py polling dashboard --rooms 300 --tabs 100
+    python benchmarks/run.py analytics --log-rows 2000000 --json results.json
+
+Scenarios:
+    polling     M browser tabs polling /api/fan_status every --interval seconds
+    dashboard   --clients concurrent users rendering /dashboard back to back
+    bulk        toggling --batch rooms per /api/fans/bulk request
+    automation  AutomationEngine sweeps over --automation-rooms rooms
+    analytics   /api/analytics and range queries over --log-rows runtime log rows
+
+Each run gets a throwaway database in a temp directory, a MockUpstream with
+--rooms synthetic rooms, and gpiozero's mock pin factory. Fans beyond the
+board's GPIO pins use hardware's counting relay driver. The app is served by werkzeug's
+threaded server on a local port, in this process, so client and server share
+the GIL: compare numbers between runs on the same machine, not with
+production. Reports p50/p99 latency, throughput and memory per scenario.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_upstream import MockUpstream, room_names
+
+SCENARIOS = ('polling', 'dashboard', 'bulk', 'automation', 'analytics')
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'Bench-passw0rd!'
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux), or the peak where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[max(0, math.ceil(p / 100 * len(sorted_samples)) - 1)]
+
+
+class Recorder:
+    """Collects latency samples from any number of threads."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.rss_before = rss_mb()
+        self.start()
+
+    def start(self):
+        """Start the throughput clock, after any setup the scenario needs."""
+        self.started = self.finished = time.perf_counter()
+
+    def add(self, seconds, ok=True):
+        with self._lock:
+            self.finished = time.perf_counter()
+            self.samples.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    def measure(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.add(time.perf_counter() - start, ok=False)
+            raise
+        self.add(time.perf_counter() - start)
+        return result
+
+    def result(self):
+        elapsed = self.finished - self.started
+        samples = sorted(self.samples)
+        return {
+            'scenario': self.name,
+            'ops': len(samples),
+            'errors': self.errors,
+            'seconds': round(elapsed, 3),
+            'ops_per_sec': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(samples, 50) * 1000, 2),
+            'p99_ms': round(percentile(samples, 99) * 1000, 2),
+            'max_ms': round((samples[-1] if samples else 0) * 1000, 2),
+            'rss_mb': round(rss_mb(), 1),
+            'rss_delta_mb': round(rss_mb() - self.rss_before, 1),
+        }
+
+
+class Bench:
+    """The app under test, its mock upstream and helpers shared by the scenarios."""
+
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='airaware-bench-')
+        self.upstream = MockUpstream(args.rooms, latency=args.upstream_latency).start()
+        # Read by config.py and db.py, so set before anything imports them
+        os.environ['AIRAWARE_DB'] = os.path.join(self.tmpdir.name, 'airaware.db')
+        os.environ['AIRAWARE_CO2_API_URL'] = self.upstream.url
+        os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+
+        import app as app_module
+        import hardware
+        import inventory
+        from auth import save_user
+        from werkzeug.security import generate_password_hash
+        from werkzeug.serving import make_server
+
+        hardware.CountingRelay.delay = args.relay_latency
+        app_module.configure_logging()
+        self.app = app_module.create_app()
+        save_user(BENCH_USER, generate_password_hash(BENCH_PASSWORD))
+        self.inventory = inventory
+        self.next_pin = hardware.FIRST_VIRTUAL_PIN
+        self.assign_fans(room_names(args.rooms))
+
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, name='bench-http', daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def assign_fans(self, rooms):
+        """Give every room a fan, adding counting relays to the inventory as needed."""
+        from fan_handler import apply_fan_changes, get_assigned_rooms
+        missing = [room for room in rooms if room not in get_assigned_rooms()]
+        for _ in missing:
+            self.inventory.add_device(self.next_pin, 'counting', f"bench/{self.next_pin}")
+            self.next_pin += 1
+        apply_fan_changes(assigns=missing)
+
+    def client(self, login=True):
+        import requests
+        session = requests.Session()
+        if login:
+            response = session.post(
+                f"{self.base_url}/login", data={'username': BENCH_USER, 'password': BENCH_PASSWORD},
+                allow_redirects=False
+            )
+            if response.status_code != 302 or 'dashboard' not in response.headers.get('Location', ''):
+                raise RuntimeError("Benchmark user could not log in")
+        return session
+
+    def run_clients(self, recorder, count, request, interval=0.0):
+        """Run `count` client threads calling request(session) until --duration is up."""
+        sessions = [self.client() for _ in range(count)]
+        deadline = time.perf_counter() + self.args.duration
+
+        def loop(session):
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    ok = request(session).ok
+                except Exception:
+                    ok = False
+                taken = time.perf_counter() - start
+                recorder.add(taken, ok)
+                if interval:
+                    time.sleep(max(0.0, interval - taken))
+
+        threads = [threading.Thread(target=loop, args=(session,)) for session in sessions]
+        recorder.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        self.server.shutdown()
+        self.upstream.stop()
+        self.tmpdir.cleanup()
+
+
+def bench_polling(bench):
+    recorder = Recorder('polling')
+    url = f"{bench.base_url}/api/fan_status"
+    bench.run_clients(recorder, bench.args.tabs, lambda session: session.get(url), bench.args.interval)
+    return [recorder.result()]
+
+
+def bench_dashboard(bench):
+    recorder = Recorder('dashboard')
+    url = f"{bench.base_url}/dashboard"
+    bench.run_clients(recorder, bench.args.clients, lambda session: session.get(url))
+    return [recorder.result()]
+
+
+def bench_bulk(bench):
+    from hardware import CountingRelay
+
+    recorder = Recorder('bulk')
+    url = f"{bench.base_url}/api/fans/bulk"
+    rooms = room_names(bench.args.rooms)
+    batch = min(bench.args.batch, len(rooms))
+    state = {'turn': 0}
+
+    def toggle(session):
+        # Alternate between switching a batch on and off again
+        state['turn'] += 1
+        op = 'on' if state['turn'] % 2 else 'off'
+        start = (state['turn'] // 2 * batch) % len(rooms)
+        chosen = (rooms * 2)[start:start + batch]
+        return session.post(url, json=[{'op': op, 'room': room} for room in chosen])
+
+    switches = CountingRelay.switches
+    bench.run_clients(recorder, 1, toggle)
+    result = recorder.result()
+    result['relay_switches'] = CountingRelay.switches - switches
+    return [result]
+
+
+def bench_automation(bench):
+    from api_handler import RoomSnapshot
+    from automation import AutomationEngine
+    from locks import room_locks
+
+    rooms = [f"A{i:05d}" for i in range(bench.args.automation_rooms)]
+    bench.assign_fans(rooms)
+    rng = random.Random(2)
+    levels = {room: rng.randint(600, 1300) for room in rooms}
+    clock = {'now': 0.0}
+    engine = AutomationEngine(room_locks, building_id='bench', clock=lambda: clock['now'])
+
+    recorder = Recorder('automation')
+    toggles = 0
+    build_seconds = 0.0
+    for version in range(1, bench.args.sweeps + 1):
+        build_start = time.perf_counter()
+        for room in rooms:
+            levels[room] = min(2500, max(400, levels[room] + rng.randint(-60, 60)))
+        snapshot = RoomSnapshot(
+            [{'id': f"dev-{room}", 'roomGroupName': room, 'co2': level} for room, level in levels.items()],
+            version=version, fetched_at=time.time()
+        )
+        build_seconds += time.perf_counter() - build_start
+        clock['now'] += 30  # one upstream poll between sweeps
+        toggles += len(recorder.measure(engine.evaluate, snapshot) or ())
+    recorder.started += build_seconds  # count only time spent evaluating
+    result = recorder.result()
+    result['rooms'] = len(rooms)
+    result['toggles'] = toggles
+    return [result]
+
+
+def _fill_runtime_log(rows, rooms):
+    """Write `rows` ON/OFF events spread over the last 90 days, then rebuild the rollups."""
+    from analytics_handler import ensure_runtime_schema
+    from db import get_db
+
+    conn = get_db()
+    ensure_runtime_schema(conn)
+    now = int(time.time())
+    start = now - 90 * 86400
+    per_room = max(2, rows // len(rooms))
+    step = (now - start) // per_room
+    batch = []
+    with conn:
+        for room in rooms:
+            for i in range(per_room):
+                ts = start + i * step
+                batch.append((room, 'ON' if i % 2 == 0 else 'OFF', datetime.fromtimestamp(ts).isoformat(), ts))
+                if len(batch) >= 50000:
+                    conn.executemany('INSERT INTO fan_runtime_log (room, action, timestamp, ts) VALUES (?, ?, ?, ?)', batch)
+                    batch.clear()
+        conn.executemany('INSERT INTO fan_runtime_log (room, action, timestamp, ts) VALUES (?, ?, ?, ?)', batch)
+    return per_room * len(rooms)
+
+
+def bench_analytics(bench):
+    import analytics_handler
+    from api_handler import get_room_snapshot
+    from fan_handler import get_fans
+
+    # Results are taken right after each phase so rss_mb is that phase's
+    rooms = room_names(bench.args.rooms)
+    fill = Recorder('analytics.fill')
+    written = fill.measure(_fill_runtime_log, bench.args.log_rows, rooms)
+    results = [dict(fill.result(), rows=written)]
+    rebuild = Recorder('analytics.rebuild')
+    rebuild.measure(analytics_handler.rebuild_runtime_intervals)
+    results.append(rebuild.result())
+
+    snapshot = get_room_snapshot()
+    uncached = Recorder('analytics.uncached')
+    for _ in range(bench.args.iterations):
+        analytics_handler.invalidate_analytics()
+        uncached.measure(analytics_handler.get_analytics, snapshot.rooms, get_fans())
+    results.append(uncached.result())
+
+    window = Recorder('analytics.intervals_30d')
+    now = int(time.time())
+    for i in range(bench.args.iterations):
+        window.measure(analytics_handler.load_runtime_intervals, rooms[i % len(rooms)], now - 30 * 86400, now)
+    results.append(window.result())
+
+    http = Recorder('analytics.http')
+    url = f"{bench.base_url}/api/analytics"
+    bench.run_clients(http, bench.args.clients, lambda session: session.get(url))
+    results.append(http.result())
+    return results
+
+
+def print_results(results):
+    columns = ('ops', 'ops_per_sec', 'p50_ms', 'p99_ms', 'max_ms', 'errors', 'rss_mb', 'rss_delta_mb')
+    print(f"{'scenario':<24}" + ''.join(f"{column:>13}" for column in columns))
+    for result in results:
+        print(f"{result['scenario']:<24}" + ''.join(f"{result[column]:>13}" for column in columns))
+    print(f"peak rss: {peak_rss_mb():.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--rooms', type=int, default=100, help="rooms served by the mock upstream, each with a fan")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per HTTP scenario")
+    parser.add_argument('--tabs', type=int, default=50, help="polling browser tabs")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between polls of one tab")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients for dashboard and analytics")
+    parser.add_argument('--batch', type=int, default=50, help="rooms per bulk request")
+    parser.add_argument('--automation-rooms', type=int, default=2000)
+    parser.add_argument('--sweeps', type=int, default=50, help="automation snapshots to evaluate")
+    parser.add_argument('--log-rows', type=int, default=1000000, help="fan_runtime_log rows for analytics")
+    parser.add_argument('--iterations', type=int, default=20, help="repeats of the in-process analytics queries")
+    parser.add_argument('--upstream-latency', type=float, default=0.0, help="seconds the mock upstream waits per request")
+    parser.add_argument('--relay-latency', type=float, default=0.0, help="seconds per relay switch")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    bench = Bench(args)
+    results = []
+    try:
+        for scenario in args.scenarios:
+            print(f"running {scenario}...", file=sys.stderr)
+            results.extend(globals()[f"bench_{scenario}"](bench))
+    finally:
+        bench.close()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'results': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Cold start benchmark: how long a fresh process takes until it can serve.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --fans 300 --upstream-latency 1.0 --json startup.json
+
+Every run starts a new Python process that imports the app, calls
+create_app() and then asks /api/get_co2_levels for data, the first thing a
+dashboard does. Runs come in two kinds: `fresh` starts from an empty
+database, so create_app() has to build the schema, and `existing` reuses a
+migrated database with --fans fans assigned. The upstream is a MockUpstream
+that takes --upstream-latency seconds per request, like the real API on a
+slow day. Times are measured from process spawn and reported as the median
+and max over --runs runs:
+
+    interpreter   spawn until the child's first line of Python runs
+    import        `import app` done
+    ready         create_app() returned: the process can take requests
+    first data    first /api/get_co2_levels response with rooms in it
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+START = time.monotonic()  # as early as possible: the child's interpreter start ends here
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ('interpreter', 'import', 'ready', 'first data')
+
+
+def child():
+    """Start the app in this process and print monotonic timestamps as JSON."""
+    marks = {'interpreter': START}
+    import app
+    marks['import'] = time.monotonic()
+    loaded = {name: name in sys.modules for name in ('requests', 'gpiozero')}
+    app.create_app()
+    marks['ready'] = time.monotonic()
+    client = app.app.test_client()
+    while not client.get('/api/get_co2_levels').get_json():
+        time.sleep(0.01)
+    marks['first data'] = time.monotonic()
+    print(json.dumps({'marks': marks, 'loaded': loaded}), flush=True)
+    # Skip interpreter shutdown: the leader's background threads would keep running
+    os._exit(0)
+
+
+def seed_fans(db_path, count):
+    """Assign `count` fans on counting relays in an already migrated database."""
+    from hardware import FIRST_VIRTUAL_PIN
+    conn = sqlite3.connect(db_path)
+    with conn:
+        pins = range(FIRST_VIRTUAL_PIN, FIRST_VIRTUAL_PIN + count)
+        conn.executemany("INSERT OR IGNORE INTO devices (pin, driver) VALUES (?, 'counting')", [(pin,) for pin in pins])
+        conn.executemany(
+            "INSERT OR IGNORE INTO fan_assignments (room, status, pin, manual) VALUES (?, 'OFF', ?, 0)",
+            [(f"R{i:04d}", pin) for i, pin in enumerate(pins)]
+        )
+    conn.close()
+
+
+def run_once(env):
+    spawned = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child'],
+        env=env, cwd=ROOT, capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"startup failed:\n{result.stderr}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return {phase: report['marks'][phase] - spawned for phase in PHASES}, report['loaded']
+
+
+def summarize(name, runs):
+    summary = {}
+    print(f"\n{name} ({len(runs)} runs)")
+    print(f"  {'phase':<12} {'median':>9} {'max':>9}")
+    for phase in PHASES:
+        samples = [run[phase] for run in runs]
+        summary[phase] = {'median': statistics.median(samples), 'max': max(samples)}
+        print(f"  {phase:<12} {summary[phase]['median'] * 1000:7.1f}ms {summary[phase]['max'] * 1000:7.1f}ms")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help="process starts per kind")
+    parser.add_argument('--rooms', type=int, default=100, help="rooms served by the mock upstream")
+    parser.add_argument('--fans', type=int, default=100, help="fans assigned in the existing database")
+    parser.add_argument('--upstream-latency', type=float, default=0.5, help="seconds the mock upstream waits per request")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child()
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+
+    from mock_upstream import MockUpstream
+    upstream = MockUpstream(args.rooms, latency=args.upstream_latency).start()
+    results = {}
+    loaded = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix='airaware-startup-') as tmp:
+            env = dict(os.environ, GPIOZERO_PIN_FACTORY='mock', AIRAWARE_CO2_API_URL=upstream.url)
+            fresh = []
+            for i in range(args.runs):
+                os.makedirs(os.path.join(tmp, f'fresh{i}'))
+                env['AIRAWARE_DB'] = os.path.join(tmp, f'fresh{i}', 'airaware.db')
+                timings, loaded = run_once(env)
+                fresh.append(timings)
+            # Reuse the last fresh database, now migrated, for the warm runs
+            seed_fans(env['AIRAWARE_DB'], args.fans)
+            existing = [run_once(env)[0] for _ in range(args.runs)]
+    finally:
+        upstream.stop()
+
+    results['fresh'] = summarize('fresh database', fresh)
+    results['existing'] = summarize(f'existing database, {args.fans} fans', existing)
+    print("\nimported by `import app`: "
+          + ', '.join(f"{name}={'yes' if present else 'no'}" for name, present in loaded.items()))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'results': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
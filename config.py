@@ -1,17 +1,27 @@
-import logging
+import os
 
 # Flask secret key
 SECRET_KEY = 'your_secret_key'
 
-# Logging configuration
-logging.basicConfig(level=logging.DEBUG)
-
-
 # API Config
-CO2_API_URL = "https://co2.mesh.lv/api/device/list"
+CO2_API_URL = os.environ.get('AIRAWARE_CO2_API_URL', "https://co2.mesh.lv/api/device/list")
 BUILDING_ID = "512"
+BUILDING_IDS = [BUILDING_ID]  # buildings kept warm by the background refresher
+USE_ASYNC_PIPELINE = False  # poll and automate with pipeline.py's event loop instead of threads
 HEADERS = {
     'Content-Type': 'application/json',
     'Accept': 'application/json',
     'User-Agent': 'Mozilla/5.0 (X11; CrOS x86_64 14541.0.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36',
 }
+
+# Automation: a fan switches on at or above the on level and back off below
+# the off level. The gap between the two stops relays chattering around one value.
+AUTOMATION_ON_PPM = 1000
+AUTOMATION_OFF_PPM = 900
+AUTOMATION_ROOM_THRESHOLDS = {}  # room -> (on_ppm, off_ppm) overrides
+AUTOMATION_MIN_RUN_SECONDS = 120  # minimum time a fan stays on once automation starts it
+AUTOMATION_MIN_IDLE_SECONDS = 60  # minimum time a fan stays off once automation stops it
+
+# Simulation: when set, the leader appends every snapshot to this recording
+# for `python simulation.py replay` (see simulation.py)
+RECORD_FILE = os.environ.get('AIRAWARE_RECORD_FILE')
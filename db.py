@@ -0,0 +1,71 @@
+import logging
+import os
+import sqlite3
+import threading
+
+DB_FILE = os.environ.get('AIRAWARE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'airaware.db'))
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 128
+MAX_IDLE_CONNECTIONS = 8
+
+# Every thread gets its own connection. Connections from short-lived request
+# threads are handed back to _idle by release_db() so the next request can
+# reuse them instead of paying for connect + pragmas again.
+_local = threading.local()
+_idle = []
+_pool_lock = threading.Lock()
+
+# Set once airaware.init_database() has brought the schema to the latest
+# version in this process, so modules can skip their own first-use checks.
+schema_current = threading.Event()
+
+
+def connect(path=DB_FILE):
+    """Open a new connection with the pragmas every module relies on."""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False  # pooled connections move between threads, one at a time
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    logging.debug(f"Opened database connection to {path}")
+    return conn
+
+
+def get_db():
+    """Return the calling thread's database connection, reusing a pooled one if possible."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        with _pool_lock:
+            conn = _idle.pop() if _idle else None
+        if conn is None:
+            conn = connect()
+        _local.conn = conn
+    return conn
+
+
+def release_db():
+    """Give the calling thread's connection back to the pool."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        if len(_idle) < MAX_IDLE_CONNECTIONS:
+            _idle.append(conn)
+            return
+    conn.close()
+
+
+def close_all():
+    """Close the calling thread's connection and every pooled connection."""
+    release_db()
+    with _pool_lock:
+        while _idle:
+            _idle.pop().close()
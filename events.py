@@ -0,0 +1,55 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+
+MAX_QUEUED_EVENTS = 256  # per subscriber; a client that falls this far behind is dropped
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_event_ids = itertools.count(1)
+
+
+def format_sse(event, data, event_id=None):
+    """Format one Server-Sent Events message."""
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+    return message
+
+
+def subscribe():
+    """Register a new subscriber and return the queue its messages arrive on."""
+    subscription = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+    with _subscribers_lock:
+        _subscribers.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with _subscribers_lock:
+        _subscribers.discard(subscription)
+
+
+def publish(event, data):
+    """Send an event to every subscriber. The message is serialized once."""
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    if not subscribers:
+        return
+    message = format_sse(event, data, next(_event_ids))
+    for subscription in subscribers:
+        try:
+            subscription.put_nowait(message)
+        except queue.Full:
+            # Too slow to keep up: end its stream, the browser reconnects and resyncs
+            logging.warning("Dropping slow event stream subscriber")
+            unsubscribe(subscription)
+            with subscription.mutex:
+                subscription.queue.clear()
+            subscription.put_nowait(None)
+
+
+def subscriber_count():
+    return len(_subscribers)
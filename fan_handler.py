@@ -1,55 +1,286 @@
 import logging
 import sqlite3
-import os
-
-AVAILABLE_FAN_PINS = [23, 24, 25]
-DB_FILE = os.path.abspath('airaware.db') 
-
-def get_db():
-    """Establish a connection to the database."""
-    logging.debug(f"Connecting to database file: {os.path.abspath(DB_FILE)}")  # Log the absolute path
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+import threading
+import time
+from db import get_db
+from analytics_handler import log_fan_actions
+from inventory import claim_pins, pin_allocator
+from metrics import DB_QUERY_SECONDS, timed
+import events
 
+@timed(DB_QUERY_SECONDS, call_site='load_fan_assignments')
 def load_fan_assignments():
     """Load fan assignments from the database."""
     try:
         conn = get_db()
         cursor = conn.cursor()
-        
-        # Ensure the table exists
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS fan_assignments (
-                room TEXT PRIMARY KEY,
-                status TEXT NOT NULL,
-                pin INTEGER NOT NULL
-            )
-        ''')
-        
-        cursor.execute("SELECT room, status, pin FROM fan_assignments")
+
+        cursor.execute("SELECT room, status, pin, manual FROM fan_assignments")
         rows = cursor.fetchall()
         
-        fan_assignments = [{'room': row['room'], 'status': row['status'], 'pin': row['pin']} for row in rows]
+        fan_assignments = [
+            {'room': row['room'], 'status': row['status'], 'pin': row['pin'], 'manual': bool(row['manual'])}
+            for row in rows
+        ]
         return fan_assignments
     except sqlite3.Error as e:
         logging.error(f"Error loading fan assignments: {e}")
         return []
-    finally:
-        conn.close()  # Ensure the connection is always closed
-        logging.info("Database connection closed.")
 
-def save_fan_assignments(fan_assignments):
-    """Save fan assignments to the database."""
+def _write_fan_changes(conn, upserts, deletes):
+    upserts = [(fan['room'], fan['status'], fan['pin'], int(fan.get('manual', False))) for fan in upserts]
+    if deletes:
+        conn.executemany("DELETE FROM fan_assignments WHERE room = ?", [(room,) for room in deletes])
+    if upserts:
+        conn.executemany(
+            """INSERT INTO fan_assignments (room, status, pin, manual) VALUES (?, ?, ?, ?)
+               ON CONFLICT(room) DO UPDATE
+               SET status = excluded.status, pin = excluded.pin, manual = excluded.manual""",
+            upserts
+        )
+
+@timed(DB_QUERY_SECONDS, call_site='save_fan_changes')
+def save_fan_changes(upserts=(), deletes=()):
+    """Persist only the fan rows that changed, in a single transaction."""
+    upserts = list(upserts)
+    deletes = list(deletes)
+    if not upserts and not deletes:
+        return
+    conn = get_db()
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM fan_assignments")
-        for fan in fan_assignments:
-            cursor.execute(
-                "INSERT INTO fan_assignments (room, status, pin) VALUES (?, ?, ?)",
-                (fan['room'], fan['status'], fan['pin'])
-            )
-        conn.commit()
+        with conn:
+            _write_fan_changes(conn, upserts, deletes)
     except sqlite3.Error as e:
-        logging.error(f"Error saving fan assignments: {e}")
+        logging.error(f"Error saving fan changes: {e}")
+        raise
+
+# In-memory fan-state registry.
+#
+# The registry is the authoritative view of fan state for the running process.
+# It is loaded once at startup and written through to SQLite only when a fan is
+# added, removed or changes status. Writers replace the whole dict under
+# _registry_lock (copy-on-write), so readers can use it without locking.
+# Every swap bumps _registry_version, which HTTP handlers use as an ETag.
+_registry = {}
+_registry_lock = threading.Lock()
+_registry_version = (0, time.time())  # (counter, time of the last swap)
+
+
+def _swap(registry):
+    """Install a new registry. Call with _registry_lock held."""
+    global _registry, _registry_version
+    _registry = registry
+    _registry_version = (_registry_version[0] + 1, time.time())
+
+
+def _publish(registry, upserts=(), deletes=()):
+    """Write the changed rows through to the database, then swap in the new registry."""
+    save_fan_changes(upserts, deletes)
+    _swap(registry)
+
+
+def init_fan_registry():
+    """Load fan assignments from the database into the in-memory registry."""
+    now = time.time()
+    fans = load_fan_assignments()
+    with _registry_lock:
+        _swap({
+            fan['room']: {**fan, 'co2': None, 'last_change': now}
+            for fan in fans
+        })
+    logging.info(f"Fan registry loaded with {len(fans)} fans.")
+
+
+def get_registry_version():
+    """Return (version, changed_at) of the registry; the version increases with every change."""
+    return _registry_version
+
+
+def get_fans():
+    """Return a copy of all registered fans."""
+    return [dict(fan) for fan in _registry.values()]
+
+
+def get_assigned_rooms():
+    """Return a read-only view of the rooms that have a fan."""
+    return _registry.keys()
+
+
+def get_fan(room):
+    """Return a copy of the fan assigned to a room, or None."""
+    fan = _registry.get(room)
+    return dict(fan) if fan is not None else None
+
+
+def assign_fan(room):
+    """Give a room a fan on the next free pin.
+
+    Returns the new fan, or None if the room already has one or no pin is free.
+    """
+    return apply_fan_changes(assigns=[room]).get(room)
+
+
+def unregister_fan(room):
+    """Remove a fan from the registry. Returns the removed fan, or None."""
+    with _registry_lock:
+        fan = _registry.get(room)
+        if fan is None:
+            return None
+        registry = dict(_registry)
+        del registry[room]
+        _publish(registry, deletes=[room])
+        pin_allocator.release(fan['pin'])
+        if fan['status'] == 'ON':
+            log_fan_actions([(room, 'OFF')])
+        events.publish('fan_removed', {'room': room})
+        return dict(fan)
+
+
+def set_fan_statuses(statuses, manual=None):
+    """Set the status of several fans at once.
+
+    manual, if given, also sets or clears the manual override on those fans.
+    Only fans that actually changed are written, in one transaction.
+    Returns a dict of room -> updated fan for the rooms that are registered.
+    """
+    with _registry_lock:
+        previous = _registry
+        now = time.time()
+        changed = {}
+        for room, status in statuses.items():
+            fan = previous.get(room)
+            if fan is None:
+                continue
+            wanted_manual = fan['manual'] if manual is None else manual
+            if fan['status'] == status and fan['manual'] == wanted_manual:
+                continue
+            changed[room] = {
+                **fan, 'status': status, 'manual': wanted_manual,
+                'last_change': now if fan['status'] != status else fan['last_change']
+            }
+        if changed:
+            _publish({**previous, **changed}, upserts=changed.values())
+            log_fan_actions(
+                (room, fan['status']) for room, fan in changed.items()
+                if fan['status'] != previous[room]['status']
+            )
+            for fan in changed.values():
+                events.publish('fan', fan)
+        return {room: dict(_registry[room]) for room in statuses if room in _registry}
+
+
+def apply_fan_changes(assigns=(), statuses=None, removes=()):
+    """Assign, update and remove many fans in one registry swap and one transaction.
+
+    assigns lists rooms that should get a fan on a free pin (rooms that already
+    have one are skipped), statuses maps room -> (status, manual) and removes
+    lists rooms. Pins are claimed inside a BEGIN IMMEDIATE transaction, so
+    concurrent assigns from other processes never get the same pin.
+    Returns a dict of room -> fan as it is now, or None for rooms without one.
+    """
+    statuses = statuses or {}
+    with _registry_lock:
+        previous = _registry
+        registry = dict(previous)
+        now = time.time()
+        upserts = {}
+        actions = []
+        claimed = []
+        conn = get_db()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                new_rooms = [
+                    room for room in dict.fromkeys(assigns)
+                    if room not in registry
+                    and not conn.execute('SELECT 1 FROM fan_assignments WHERE room = ?', (room,)).fetchone()
+                ]
+                claimed = claim_pins(conn, len(new_rooms)) if new_rooms else []
+                for room, pin in zip(new_rooms, claimed):
+                    upserts[room] = registry[room] = {
+                        'room': room, 'status': 'OFF', 'pin': pin, 'manual': False,
+                        'co2': None, 'last_change': now
+                    }
+                for room, (status, manual) in statuses.items():
+                    fan = registry.get(room)
+                    if fan is None or (fan['status'] == status and fan['manual'] == manual):
+                        continue
+                    if fan['status'] != status:
+                        actions.append((room, status))
+                    upserts[room] = registry[room] = {
+                        **fan, 'status': status, 'manual': manual,
+                        'last_change': now if fan['status'] != status else fan['last_change']
+                    }
+                deletes = [room for room in dict.fromkeys(removes) if room in registry]
+                for room in deletes:
+                    if registry.pop(room)['status'] == 'ON':
+                        actions.append((room, 'OFF'))
+                    upserts.pop(room, None)
+                _write_fan_changes(conn, upserts.values(), deletes)
+        except Exception:
+            for pin in claimed:
+                pin_allocator.release(pin)
+            raise
+        _swap(registry)
+        for room in deletes:
+            if room in previous:
+                pin_allocator.release(previous[room]['pin'])
+        if upserts or deletes:
+            log_fan_actions(actions)
+            for fan in upserts.values():
+                events.publish('fan', fan)
+            for room in deletes:
+                events.publish('fan_removed', {'room': room})
+        rooms = set(assigns) | set(statuses) | set(removes)
+        return {room: dict(registry[room]) if room in registry else None for room in rooms}
+
+
+def set_fan_status(room, status, manual=None):
+    """Set a fan's status. Only writes to the database if something changed."""
+    return set_fan_statuses({room: status}, manual=manual).get(room)
+
+
+def reload_fan_registry():
+    """Pick up fan changes another process wrote to the database.
+
+    Returns the list of fans that were added or changed.
+    """
+    with _registry_lock:
+        # Read under the lock: a write from this process between the read and
+        # the swap would otherwise be rolled back to the row read before it
+        now = time.time()
+        stored = {fan['room']: fan for fan in load_fan_assignments()}
+        previous = _registry
+        registry = {}
+        changed = []
+        for room, fan in stored.items():
+            current = previous.get(room)
+            if current is not None and all(current[key] == fan[key] for key in ('status', 'pin', 'manual')):
+                registry[room] = current
+                continue
+            registry[room] = {
+                **fan,
+                'co2': current['co2'] if current else None,
+                'last_change': now if current is None or current['status'] != fan['status'] else current['last_change']
+            }
+            changed.append(registry[room])
+        removed = [room for room in previous if room not in stored]
+        if changed or removed:
+            _swap(registry)
+    for fan in changed:
+        events.publish('fan', fan)
+    for room in removed:
+        events.publish('fan_removed', {'room': room})
+    return changed
+
+
+def update_fan_co2(co2_lookup):
+    """Record the latest CO2 readings for registered fans. Memory only."""
+    with _registry_lock:
+        changed = {
+            room: {**fan, 'co2': co2_lookup[room]}
+            for room, fan in _registry.items()
+            if room in co2_lookup and fan['co2'] != co2_lookup[room]
+        }
+        if changed:
+            _swap({**_registry, **changed})
@@ -1,39 +1,175 @@
 # filepath: /home/izm/testing/projekts2/hardware.py
 import logging
 import atexit
+import threading
 import time
-from gpiozero import OutputDevice, GPIOZeroError
+from concurrent.futures import Future
+from inventory import load_devices
+from metrics import GPIO_ACTUATION_SECONDS
 
 # Dictionary to store relay devices and their states
 fan_devices = {}
 fan_states = {}
+_devices_lock = threading.Lock()
+
+# Drivers turn a device from the inventory into an object with on(), off()
+# and close(). _device_specs maps pin -> (driver name, address); pins missing
+# from it are plain GPIO pins.
+_drivers = {}
+_device_specs = {}
+
+# Actuator queue: pin -> (wanted state, futures waiting on it). A newer command
+# for a pin replaces the pending one (last write wins) and the single worker
+# thread applies everything that queued up in one pass.
+_pending = {}
+_pending_cond = threading.Condition()
+_worker = None
+_cleanup_registered = False
+
+def register_driver(name, factory):
+    """Make a device driver available. factory(pin, address) returns an object with on(), off() and close()."""
+    _drivers[name] = factory
+
+def _gpio_driver(pin, address):
+    from gpiozero import OutputDevice  # loaded on first use, not when the web app starts
+    return OutputDevice(int(address) if address else pin, active_high=False)
+
+register_driver('gpio', _gpio_driver)
+
+# Logical pins for relays that are not wired up, clear of real GPIO numbers
+FIRST_VIRTUAL_PIN = 1000
+
+class CountingRelay:
+    """Driver that only counts switches, optionally taking `delay` seconds each. For benchmarks and replays."""
+
+    switches = 0
+    delay = 0.0
+
+    def __init__(self, pin, address):
+        self.pin = pin
+
+    def on(self):
+        CountingRelay.switches += 1
+        if CountingRelay.delay:
+            time.sleep(CountingRelay.delay)
+
+    off = on
+
+    def close(self):
+        pass
+
+register_driver('counting', CountingRelay)
+
+def configure_devices(devices):
+    """Set which driver and address each pin uses, from inventory.load_devices()."""
+    specs = {pin: (device['driver'], device['address']) for pin, device in devices.items()}
+    with _devices_lock:
+        for pin, spec in specs.items():
+            if pin in fan_devices and _device_specs.get(pin, ('gpio', None)) != spec:
+                # The device was rewired; open it again with the new settings on next use
+                fan_devices.pop(pin).close()
+                fan_states.pop(pin, None)
+        _device_specs.clear()
+        _device_specs.update(specs)
 
 def initialize_fan(pin):
-    if pin not in fan_devices:
+    global _cleanup_registered
+    with _devices_lock:
+        if pin in fan_devices:
+            return
+        driver, address = _device_specs.get(pin, ('gpio', None))
+        factory = _drivers.get(driver)
+        if factory is None:
+            logging.error(f"Fan at pin {pin} uses unknown driver {driver!r}.")
+            return
         try:
-            fan_devices[pin] = OutputDevice(pin, active_high=False)  # Changed to True
-            logging.info(f"Fan at GPIO {pin} initialized successfully.")
-        except GPIOZeroError as e:
-            logging.error(f"Failed to initialize fan at GPIO {pin}: {e}")
+            fan_devices[pin] = factory(pin, address)
+            fan_states[pin] = False
+            logging.info(f"Fan at pin {pin} initialized successfully ({driver}).")
+        except Exception as e:  # GPIOZeroError, OSError, or whatever another driver raises
+            logging.error(f"Failed to initialize fan at pin {pin}: {e}")
+            return
+        if not _cleanup_registered:
+            # Only processes that actually open a device release them at exit
+            atexit.register(cleanup_gpio)
+            _cleanup_registered = True
 
-def turn_fan_on(pin):
+def _apply(pin, on):
+    """Set one pin, skipping the write if it is already in the wanted state."""
     if pin not in fan_devices:
         logging.warning(f"Fan at GPIO {pin} is not initialized. Initializing now.")
+        if pin not in _device_specs:
+            # Probably just added to the inventory; pick up its driver settings
+            configure_devices(load_devices())
         initialize_fan(pin)
-    fan_devices[pin].on()
-    logging.info(f"Fan at GPIO {pin} is ON.")
+        if pin not in fan_devices:
+            raise RuntimeError(f"Fan at pin {pin} could not be initialized.")
+    if fan_states.get(pin) == on:
+        return
+    with GPIO_ACTUATION_SECONDS.time(driver=_device_specs.get(pin, ('gpio', None))[0]):
+        if on:
+            fan_devices[pin].on()
+        else:
+            fan_devices[pin].off()
+    with _devices_lock:
+        fan_states[pin] = on
+    logging.info(f"Fan at GPIO {pin} is {'ON' if on else 'OFF'}.")
+
+def get_fan_states():
+    """Return a copy of {pin: on} for every initialized fan, safe to iterate from any thread."""
+    with _devices_lock:
+        return dict(fan_states)
+
+def _actuator_loop():
+    global _pending
+    while True:
+        with _pending_cond:
+            _pending_cond.wait_for(lambda: _pending)
+            batch, _pending = _pending, {}
+        for pin, (on, futures) in batch.items():
+            try:
+                _apply(pin, on)
+            except Exception as e:
+                logging.error(f"Failed to switch fan at GPIO {pin}: {e}")
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(on)
+
+def submit_fan_states(states):
+    """Queue {pin: on} changes without blocking. Returns {pin: Future}.
+
+    Each future resolves to the state the pin ended up in, which is the last
+    state submitted for it if several commands were coalesced.
+    """
+    global _worker
+    futures = {}
+    with _pending_cond:
+        for pin, on in states.items():
+            future = Future()
+            _, waiting = _pending.get(pin, (None, []))
+            _pending[pin] = (bool(on), waiting + [future])
+            futures[pin] = future
+        if _worker is None:
+            _worker = threading.Thread(target=_actuator_loop, name='fan-actuator', daemon=True)
+            _worker.start()
+        _pending_cond.notify()
+    return futures
+
+def submit_fan_state(pin, on):
+    """Queue a single fan change without blocking. Returns a Future."""
+    return submit_fan_states({pin: on})[pin]
+
+def turn_fan_on(pin):
+    submit_fan_state(pin, True).result()
 
 def turn_fan_off(pin):
-    if pin not in fan_devices:
-        logging.warning(f"Fan at GPIO {pin} is not initialized. Initializing now.")
-        initialize_fan(pin)
-    fan_devices[pin].off()
-    logging.info(f"Fan at GPIO {pin} is OFF.")
+    submit_fan_state(pin, False).result()
 
 def cleanup_gpio():
     for pin, device in fan_devices.items():
         device.close()
         logging.info(f"GPIO {pin} cleaned up.")
     fan_devices.clear()
-
-atexit.register(cleanup_gpio)
\ No newline at end of file
+    fan_states.clear()
@@ -0,0 +1,221 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from db import get_db, schema_current
+from metrics import DB_QUERY_SECONDS, timed
+
+RECORD_MIN_INTERVAL = 60  # seconds; an unchanged reading is stored at most this often
+RAW_RETENTION_DAYS = 7
+MINUTE_RETENTION_DAYS = 90
+HOUR_RETENTION_DAYS = 5 * 365
+PRUNE_INTERVAL = 3600
+
+# Rollup tables: resolution in seconds, table name, retention in days
+ROLLUPS = [
+    (60, 'co2_readings_1m', MINUTE_RETENTION_DAYS),
+    (3600, 'co2_readings_1h', HOUR_RETENTION_DAYS),
+]
+
+_schema_ready = False
+_last_recorded = {}  # room -> (ts, co2) of the last stored reading
+_last_prune = 0
+_recorder_queue = queue.Queue(maxsize=64)
+_recorder = None
+
+
+def ensure_history_schema(conn):
+    """Create the CO2 history tables. The (room, ts) primary keys double as covering indexes."""
+    global _schema_ready
+    if _schema_ready or schema_current.is_set():
+        return
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS co2_readings (
+                room TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                co2 INTEGER NOT NULL,
+                PRIMARY KEY (room, ts)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_co2_readings_ts ON co2_readings (ts)')
+        for _, table, _ in ROLLUPS:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    room TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    co2_min INTEGER NOT NULL,
+                    co2_max INTEGER NOT NULL,
+                    co2_sum INTEGER NOT NULL,
+                    samples INTEGER NOT NULL,
+                    PRIMARY KEY (room, bucket)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket)')
+    _schema_ready = True
+
+
+@timed(DB_QUERY_SECONDS, call_site='record_snapshot')
+def record_snapshot(snapshot, now=None):
+    """Store one snapshot's readings and fold them into the rollups, in one transaction.
+
+    A room's reading is skipped if it is unchanged and was stored less than
+    RECORD_MIN_INTERVAL seconds ago. Returns the number of readings stored.
+    """
+    ts = int(now if now is not None else snapshot.fetched_at or time.time())
+    readings = []
+    for room, co2 in snapshot.co2_by_name.items():
+        if not isinstance(co2, (int, float)):
+            continue
+        co2 = int(co2)
+        last = _last_recorded.get(room)
+        if last is not None and last[1] == co2 and ts - last[0] < RECORD_MIN_INTERVAL:
+            continue
+        readings.append((room, ts, co2))
+    if not readings:
+        return 0
+
+    conn = get_db()
+    ensure_history_schema(conn)
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO co2_readings (room, ts, co2) VALUES (?, ?, ?)', readings)
+            for resolution, table, _ in ROLLUPS:
+                conn.executemany(
+                    f'''INSERT INTO {table} (room, bucket, co2_min, co2_max, co2_sum, samples)
+                        VALUES (?, ?, ?, ?, ?, 1)
+                        ON CONFLICT(room, bucket) DO UPDATE SET
+                            co2_min = MIN(co2_min, excluded.co2_min),
+                            co2_max = MAX(co2_max, excluded.co2_max),
+                            co2_sum = co2_sum + excluded.co2_sum,
+                            samples = samples + 1''',
+                    [(room, ts - ts % resolution, co2, co2, co2) for room, ts, co2 in readings]
+                )
+            # Keep rooms.current_co2 up to date for anything still reading it
+            conn.executemany(
+                'UPDATE rooms SET current_co2 = ?, last_updated = CURRENT_TIMESTAMP WHERE room_name = ?',
+                [(co2, room) for room, _, co2 in readings]
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO rooms (room_name, device_id, current_co2) VALUES (?, ?, ?)',
+                [
+                    (room, str(snapshot.device_id(room)), co2)
+                    for room, _, co2 in readings if snapshot.device_id(room) is not None
+                ]
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error recording CO2 history: {e}")
+        return 0
+    for room, ts, co2 in readings:
+        _last_recorded[room] = (ts, co2)
+    return len(readings)
+
+
+def prune_history(now=None):
+    """Delete readings and rollups older than their retention period."""
+    now = int(now if now is not None else time.time())
+    conn = get_db()
+    ensure_history_schema(conn)
+    with conn:
+        conn.execute('DELETE FROM co2_readings WHERE ts < ?', (now - RAW_RETENTION_DAYS * 86400,))
+        for _, table, retention_days in ROLLUPS:
+            conn.execute(f'DELETE FROM {table} WHERE bucket < ?', (now - retention_days * 86400,))
+
+
+def _recorder_loop():
+    global _last_prune
+    while True:
+        snapshot = _recorder_queue.get()
+        # Log and carry on: an exception escaping here would end history recording
+        try:
+            record_snapshot(snapshot)
+        except Exception as e:
+            logging.error(f"Error recording CO2 history: {e}")
+        if time.time() - _last_prune > PRUNE_INTERVAL:
+            try:
+                prune_history()
+            except Exception as e:
+                logging.error(f"Error pruning CO2 history: {e}")
+            _last_prune = time.time()
+
+
+def queue_snapshot(building_id, snapshot):
+    """Snapshot listener: hand the snapshot to the recorder thread without blocking."""
+    try:
+        _recorder_queue.put_nowait(snapshot)
+    except queue.Full:
+        logging.warning("CO2 history recorder is falling behind, dropping a snapshot")
+
+
+def start_recorder():
+    """Start the background thread that stores every new snapshot."""
+    global _recorder
+    if _recorder is None:
+        _recorder = threading.Thread(target=_recorder_loop, name='co2-history', daemon=True)
+        _recorder.start()
+
+
+def _source_for(bucket_width, start, now=None):
+    """Pick the table to read a range from.
+
+    Normally the coarsest table whose resolution still fits inside one output
+    bucket. If that table's retention no longer reaches back to start, the
+    finest table that does, so a narrow window from weeks ago is read from
+    the rollups instead of the pruned raw readings.
+    """
+    now = now if now is not None else time.time()
+    sources = [(1, None, RAW_RETENTION_DAYS)] + ROLLUPS
+    fitting = [source for source in sources if source[0] <= bucket_width]
+    resolution, table, retention_days = fitting[-1]
+    if start >= now - retention_days * 86400:
+        return resolution, table
+    for resolution, table, retention_days in sources:
+        if start >= now - retention_days * 86400:
+            return resolution, table
+    return sources[-1][:2]
+
+
+@timed(DB_QUERY_SECONDS, call_site='load_co2_history')
+def load_co2_history(room, start, end, points=300):
+    """Return (resolution, [[ts, co2], ...]) for a room in [start, end), min/max-bucketed to about `points` points.
+
+    resolution is the width in seconds one point stands for. Each bucket
+    keeps its lowest and highest reading in time order, so spikes survive
+    downsampling. Wide ranges, and ranges older than the raw readings are
+    kept, read from the rollup tables.
+    """
+    # Every bucket contributes up to two points (its min and its max)
+    bucket_width = max(1, (end - start) * 2 // max(points, 2))
+    resolution, table = _source_for(bucket_width, start)
+    conn = get_db()
+    ensure_history_schema(conn)
+    if table is None:
+        rows = conn.execute(
+            'SELECT ts, co2, co2 FROM co2_readings WHERE room = ? AND ts >= ? AND ts < ? ORDER BY ts',
+            (room, start, end)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            f'''SELECT bucket, co2_min, co2_max FROM {table}
+                WHERE room = ? AND bucket >= ? AND bucket < ? ORDER BY bucket''',
+            (room, start - start % resolution, end)
+        ).fetchall()
+
+    series = []
+    current = None
+    low = high = None
+    for ts, co2_min, co2_max in rows:
+        bucket = (ts - start) // bucket_width
+        if bucket != current:
+            if current is not None:
+                series.extend(sorted({tuple(low), tuple(high)}))
+            current, low, high = bucket, [ts, co2_min], [ts, co2_max]
+            continue
+        if co2_min < low[1]:
+            low = [ts, co2_min]
+        if co2_max > high[1]:
+            high = [ts, co2_max]
+    if current is not None:
+        series.extend(sorted({tuple(low), tuple(high)}))
+    return max(resolution, bucket_width), [list(point) for point in series]
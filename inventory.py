@@ -0,0 +1,156 @@
+import logging
+import sqlite3
+import threading
+from collections import deque
+from db import get_db, schema_current
+
+# Fan relays the system can drive. Each device is a logical pin number (what
+# fan_assignments.pin refers to), the driver that switches it and a
+# driver-specific address: a BCM pin for 'gpio', or e.g. an expander channel
+# or a relay board URL for drivers registered in hardware.register_driver().
+# A fresh database is seeded with the three relays on the original board.
+DEFAULT_DEVICES = [(23, 'gpio', None), (24, 'gpio', None), (25, 'gpio', None)]
+
+_schema_ready = False
+
+
+def ensure_inventory_schema(conn):
+    """Create the devices table, seeding it on first use, and make pins unique per fan."""
+    global _schema_ready
+    if _schema_ready or schema_current.is_set():
+        return
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                pin INTEGER PRIMARY KEY,
+                driver TEXT NOT NULL DEFAULT 'gpio',
+                address TEXT
+            )
+        ''')
+        if conn.execute('SELECT 1 FROM devices LIMIT 1').fetchone() is None:
+            conn.executemany('INSERT INTO devices (pin, driver, address) VALUES (?, ?, ?)', DEFAULT_DEVICES)
+    try:
+        with conn:
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_fan_assignments_pin ON fan_assignments (pin)')
+    except sqlite3.IntegrityError:
+        logging.warning("Several fans share a pin; fix fan_assignments to enforce one fan per pin")
+    _schema_ready = True
+
+
+def load_devices():
+    """Return {pin: {'pin', 'driver', 'address'}} for every device in the inventory."""
+    conn = get_db()
+    ensure_inventory_schema(conn)
+    rows = conn.execute('SELECT pin, driver, address FROM devices ORDER BY pin').fetchall()
+    return {row['pin']: dict(row) for row in rows}
+
+
+def add_device(pin, driver='gpio', address=None):
+    """Add or update a device, and make its pin available if no fan uses it."""
+    conn = get_db()
+    ensure_inventory_schema(conn)
+    with conn:
+        conn.execute(
+            '''INSERT INTO devices (pin, driver, address) VALUES (?, ?, ?)
+               ON CONFLICT(pin) DO UPDATE SET driver = excluded.driver, address = excluded.address''',
+            (pin, driver, address)
+        )
+        in_use = conn.execute('SELECT 1 FROM fan_assignments WHERE pin = ?', (pin,)).fetchone()
+    if not in_use:
+        pin_allocator.release(pin)
+
+
+def remove_device(pin):
+    """Remove a device that no fan is assigned to. Returns False if it is in use."""
+    conn = get_db()
+    ensure_inventory_schema(conn)
+    with conn:
+        if conn.execute('SELECT 1 FROM fan_assignments WHERE pin = ?', (pin,)).fetchone():
+            return False
+        conn.execute('DELETE FROM devices WHERE pin = ?', (pin,))
+    pin_allocator.discard(pin)
+    return True
+
+
+class PinAllocator:
+    """Free-list of device pins with no fan assigned.
+
+    acquire() and release() are O(1). The free-list is this process's view:
+    callers must check a pin against the database inside the transaction that
+    assigns it (see claim_pins), and the list is rebuilt from the database at
+    startup and whenever it runs dry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = deque()
+        self._free_set = set()
+
+    def reconcile(self, conn=None):
+        """Rebuild the free-list from the devices and fan_assignments tables."""
+        conn = conn or get_db()
+        ensure_inventory_schema(conn)
+        rows = conn.execute('''
+            SELECT pin FROM devices
+            WHERE pin NOT IN (SELECT pin FROM fan_assignments)
+            ORDER BY pin
+        ''').fetchall()
+        with self._lock:
+            self._free = deque(row['pin'] for row in rows)
+            self._free_set = set(self._free)
+        return len(rows)
+
+    def acquire(self):
+        """Take a free pin, or return None if there is none left."""
+        with self._lock:
+            if not self._free:
+                return None
+            pin = self._free.popleft()
+            self._free_set.discard(pin)
+            return pin
+
+    def release(self, pin):
+        """Give a pin back to the free-list."""
+        with self._lock:
+            if pin not in self._free_set:
+                self._free.append(pin)
+                self._free_set.add(pin)
+
+    def discard(self, pin):
+        """Drop a pin from the free-list, e.g. when its device is removed."""
+        with self._lock:
+            if pin in self._free_set:
+                self._free_set.discard(pin)
+                self._free.remove(pin)
+
+    def free_count(self):
+        return len(self._free_set)
+
+
+pin_allocator = PinAllocator()
+
+
+def claim_pins(conn, count):
+    """Take up to `count` free pins for new fans. Call inside a BEGIN IMMEDIATE transaction.
+
+    Pins another process assigned meanwhile are skipped; if the free-list runs
+    dry it is rebuilt from the database once. Returns the claimed pins, which
+    must be released again if the transaction rolls back.
+    """
+    pins = []
+    reconciled = False
+    while len(pins) < count:
+        pin = pin_allocator.acquire()
+        if pin is None:
+            if reconciled:
+                break
+            pin_allocator.reconcile(conn)
+            for claimed in pins:
+                pin_allocator.discard(claimed)
+            reconciled = True
+            continue
+        in_use = conn.execute('SELECT 1 FROM fan_assignments WHERE pin = ?', (pin,)).fetchone()
+        known = conn.execute('SELECT 1 FROM devices WHERE pin = ?', (pin,)).fetchone()
+        if not in_use and known:
+            pins.append(pin)
+    return pins
@@ -0,0 +1,69 @@
+import threading
+import time
+from contextlib import contextmanager
+from metrics import LOCK_WAIT_SECONDS
+
+DEFAULT_STRIPES = 64
+
+
+class RoomLocks:
+    """Per-room locking, striped over a fixed pool of locks.
+
+    Operations on different rooms run in parallel; operations on the same room
+    are serialized. Locks for several rooms are always taken in stripe order,
+    so holding more than one cannot deadlock.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'acquisitions': 0,
+            'contended': 0,
+            'wait_seconds': 0.0,
+            'hold_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'max_hold_seconds': 0.0,
+        }
+
+    def _stripes(self, rooms):
+        return sorted({hash(room) % len(self._locks) for room in rooms})
+
+    @contextmanager
+    def hold(self, *rooms):
+        """Hold the locks for the given rooms for the duration of the with block."""
+        stripes = self._stripes(rooms)
+        start = time.perf_counter()
+        contended = False
+        for stripe in stripes:
+            lock = self._locks[stripe]
+            if not lock.acquire(blocking=False):
+                contended = True
+                lock.acquire()
+        acquired = time.perf_counter()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._locks[stripe].release()
+            self._record(acquired - start, time.perf_counter() - acquired, contended)
+
+    def _record(self, waited, held, contended):
+        LOCK_WAIT_SECONDS.observe(waited)
+        with self._stats_lock:
+            stats = self._stats
+            stats['acquisitions'] += 1
+            stats['contended'] += contended
+            stats['wait_seconds'] += waited
+            stats['hold_seconds'] += held
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            stats['max_hold_seconds'] = max(stats['max_hold_seconds'], held)
+
+    def stats(self):
+        """Return a copy of the lock wait, hold time and contention counters."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+# The one instance shared by the web handlers and the automation engine
+room_locks = RoomLocks()
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import api_handler
+from automation import AutomationEngine
+from config import BUILDING_IDS, CO2_API_URL, HEADERS
+from metrics import UPSTREAM_ERRORS, UPSTREAM_FETCH_SECONDS
+
+try:
+    import aiohttp
+except ImportError:  # fall back to the requests session in a thread pool
+    aiohttp = None
+
+POLL_INTERVAL = 10  # seconds between polls of one building
+REQUEST_TIMEOUT = 10
+QUEUE_SIZE = 64
+
+
+class AsyncPipeline:
+    """Asyncio pipeline: poll buildings -> queue -> automation -> actuator executor.
+
+    One task per building polls the CO2 API concurrently and installs each
+    result with api_handler.publish_snapshot(), so request handlers see the
+    same snapshots as with the threaded refresher. Snapshots then flow through
+    an asyncio.Queue to the automation engines. Their blocking work (gpiozero
+    calls and SQLite writes) runs on a dedicated single-thread executor, so
+    the event loop itself never blocks.
+    """
+
+    def __init__(self, locks, building_ids=BUILDING_IDS, interval=POLL_INTERVAL):
+        self.building_ids = list(building_ids)
+        self.interval = interval
+        self.engines = {building_id: AutomationEngine(locks, building_id) for building_id in self.building_ids}
+        self.queue = None
+        self.actuator_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline-actuator')
+        self.fetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='pipeline-fetch')
+
+    async def fetch(self, session, building_id):
+        """Fetch one building's room data. Returns None on any failure."""
+        if session is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.fetch_executor, api_handler._fetch_room_data, building_id)
+        payload = {"buildingId": building_id, "captchaToken": None}
+        with UPSTREAM_FETCH_SECONDS.time(building=building_id):
+            try:
+                async with session.post(CO2_API_URL, json=payload) as response:
+                    if response.status != 200:
+                        logging.error(f"Request failed with status code {response.status}")
+                        UPSTREAM_ERRORS.inc(building=building_id, reason='status')
+                        return None
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.error(f"Request to CO2 API failed for building {building_id}: {e}")
+                if isinstance(e, asyncio.TimeoutError):
+                    reason = 'timeout'
+                elif isinstance(e, ValueError) and not isinstance(e, aiohttp.ClientError):
+                    reason = 'json'
+                else:
+                    reason = 'connection'
+                UPSTREAM_ERRORS.inc(building=building_id, reason=reason)
+                return None
+
+    async def poll(self, session, building_id):
+        """Poll one building forever, queueing every new snapshot."""
+        while True:
+            started = time.monotonic()
+            # Same single-flight and failure stamping as refresh_room_data(), so
+            # request handlers don't start thread-pool refreshes alongside this one
+            entry = api_handler.start_refresh(building_id)
+            if entry is not None:
+                data = None
+                try:
+                    data = await self.fetch(session, building_id)
+                finally:
+                    snapshot = api_handler.finish_refresh(building_id, entry, data)
+                if snapshot is not None:
+                    await self.queue.put((building_id, snapshot))
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    async def evaluate(self):
+        """Feed queued snapshots to the automation engine of their building."""
+        loop = asyncio.get_running_loop()
+        while True:
+            building_id, snapshot = await self.queue.get()
+            engine = self.engines[building_id]
+            try:
+                if snapshot.version > engine.version:
+                    engine.version = snapshot.version
+                    await loop.run_in_executor(self.actuator_executor, engine.evaluate, snapshot)
+            except Exception as e:
+                logging.error(f"Error in automation pipeline for building {building_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        if aiohttp is not None:
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            connector = aiohttp.TCPConnector(limit_per_host=4)
+            async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout, connector=connector) as session:
+                await self._run(session)
+        else:
+            await self._run(None)
+
+    async def _run(self, session):
+        await asyncio.gather(
+            self.evaluate(),
+            *(self.poll(session, building_id) for building_id in self.building_ids)
+        )
+
+
+def pipeline_worker(locks):
+    """Thread target that runs the asyncio pipeline in its own event loop."""
+    asyncio.run(AsyncPipeline(locks).run())
@@ -0,0 +1,155 @@
+import atexit
+import fcntl
+import logging
+import os
+import threading
+import time
+import db
+import hardware
+import history
+import inventory
+from api_handler import add_snapshot_listener, background_refresher
+from automation import automation_worker
+from config import RECORD_FILE, USE_ASYNC_PIPELINE
+from fan_handler import get_fan, get_fans, reload_fan_registry
+
+# Exactly one process (the leader) owns the GPIO pins, the CO2 refresher and
+# the automation engine. Leadership is an exclusive flock on LOCK_FILE, so it
+# passes to another worker automatically if the leader dies. Every other
+# process only serves HTTP: it writes wanted fan states to SQLite and picks up
+# the leader's changes by watching PRAGMA data_version.
+LOCK_FILE = os.path.join(os.path.dirname(db.DB_FILE), 'airaware.lock')
+LEADER_RETRY_SECONDS = 5
+STATE_SYNC_SECONDS = 1
+
+_leader = threading.Event()
+_lock_fd = None
+_started = False
+
+
+def is_leader():
+    return _leader.is_set()
+
+
+def try_become_leader():
+    """Take the leader lock if no other process holds it. Returns True on success."""
+    global _lock_fd
+    fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    _lock_fd = fd  # kept open for the life of the process
+    return True
+
+
+def apply_fan_state(pin, on):
+    """Switch a fan if this process owns the GPIO pins.
+
+    Other processes just persist the new state; the leader applies it on its
+    next state sync.
+    """
+    if not is_leader():
+        return
+    if on:
+        hardware.turn_fan_on(pin)
+    else:
+        hardware.turn_fan_off(pin)
+
+
+def apply_fan_states(states):
+    """Switch several fans in one actuator pass if this process owns the GPIO pins.
+
+    Waits for every pin and returns {pin: exception} for the ones that could
+    not be switched; the leader's reconcile retries those.
+    """
+    if not is_leader() or not states:
+        return {}
+    futures = hardware.submit_fan_states(states)
+    return {pin: future.exception() for pin, future in futures.items() if future.exception() is not None}
+
+
+def reconcile_pins(locks):
+    """Make the pins match the fan registry, and switch off pins no fan uses.
+
+    Handlers switch a relay and then update the registry while holding the
+    room's lock, so a fan that looks out of sync is checked again under its
+    lock before its pin is touched. Otherwise reconcile would undo a toggle
+    that is halfway done.
+    """
+    hardware.configure_devices(inventory.load_devices())
+    fans = get_fans()
+    states = hardware.get_fan_states()
+    assigned = {fan['pin'] for fan in fans}
+    changes = {pin: False for pin, on in states.items() if on and pin not in assigned}
+    drifted = [fan['room'] for fan in fans if states.get(fan['pin']) != (fan['status'] == 'ON')]
+    if not drifted:
+        _switch_pins(changes)
+        return
+    with locks.hold(*drifted):
+        states = hardware.get_fan_states()
+        for room in drifted:
+            fan = get_fan(room)
+            if fan is not None and states.get(fan['pin']) != (fan['status'] == 'ON'):
+                changes[fan['pin']] = fan['status'] == 'ON'
+        _switch_pins(changes)
+
+
+def _switch_pins(changes):
+    if changes:
+        logging.info(f"Reconciling {len(changes)} fan pins with stored state")
+        for future in hardware.submit_fan_states(changes).values():
+            future.result()
+
+
+def _sync_loop(locks):
+    """Reload the fan registry whenever another connection commits, and reconcile pins if leader."""
+    conn = db.connect()
+    last_version = None
+    while True:
+        try:
+            version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if version != last_version:
+                if last_version is not None:
+                    reload_fan_registry()
+                last_version = version
+            if is_leader():
+                reconcile_pins(locks)
+        except Exception as e:
+            logging.error(f"Error syncing fan state: {e}")
+        time.sleep(STATE_SYNC_SECONDS)
+
+
+def _elect(locks):
+    while not try_become_leader():
+        time.sleep(LEADER_RETRY_SECONDS)
+    logging.info(f"Process {os.getpid()} is the leader: running GPIO, CO2 refresh and automation")
+    _leader.set()
+    reconcile_pins(locks)
+    # Only the leader records CO2 history, so readings are stored once
+    history.start_recorder()
+    add_snapshot_listener(history.queue_snapshot)
+    if RECORD_FILE:
+        from simulation import SnapshotRecorder
+        recorder = SnapshotRecorder(RECORD_FILE)
+        atexit.register(recorder.close)
+        add_snapshot_listener(recorder)
+    if USE_ASYNC_PIPELINE:
+        from pipeline import pipeline_worker
+        threading.Thread(target=pipeline_worker, args=(locks,), name='pipeline', daemon=True).start()
+        return
+    threading.Thread(target=background_refresher, name='co2-refresher', daemon=True).start()
+    threading.Thread(target=automation_worker, args=(locks,), name='automation', daemon=True).start()
+
+
+def start(locks):
+    """Start state sync and leader election for this process. Safe to call more than once."""
+    global _started
+    if _started:
+        return
+    _started = True
+    threading.Thread(target=_sync_loop, args=(locks,), name='state-sync', daemon=True).start()
+    threading.Thread(target=_elect, args=(locks,), name='leader-election', daemon=True).start()
@@ -0,0 +1,334 @@
+"""Record CO2 snapshots and replay them through the automation engine, faster than real time.
+
+    python simulation.py record week.jsonl.gz --hours 168
+    python simulation.py export week.jsonl.gz --days 7
+    python simulation.py replay week.jsonl.gz --speed 0 --on-ppm 1100 --off-ppm 950
+
+`record` polls the CO2 API like the leader does and appends every snapshot
+to a recording. The leader also records while it runs if AIRAWARE_RECORD_FILE
+is set. `export` builds a recording from the CO2 history in the database,
+which keeps raw readings for history.RAW_RETENTION_DAYS days.
+
+`replay` feeds a recording to an AutomationEngine whose clock is the
+recording's timestamps. It uses a scratch database and relays that only
+count their switches, and it runs --speed times faster than real time, or
+as fast as it can with --speed 0. Then it prints fan runtime, toggles and
+time above each threshold per room. Recorded CO2 levels are replayed as
+they are, so switching a fan on in the simulation does not bring a room's
+level down.
+
+A recording is gzipped JSON lines. Each session starts with a header line.
+Then there is one line per snapshot with its time, building and the
+readings that changed since the previous line: {"t":..,"b":..,"co2":{room:
+ppm}}. A null level means the room dropped out of the snapshot.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from api_handler import RoomSnapshot, add_snapshot_listener, refresh_room_data
+from config import BUILDING_ID, BUILDING_IDS
+
+FORMAT = 'airaware-recording'
+FORMAT_VERSION = 1
+FLUSH_INTERVAL = 60  # seconds; a crashed recorder loses at most this much
+RECORD_INTERVAL = 10  # seconds between fetches when recording from the command line
+MAX_SAMPLE_GAP = 300  # seconds; a reading is not trusted for longer than this, e.g. across recorder downtime
+DEFAULT_SPEED = 1000
+
+
+class SnapshotRecorder:
+    """Appends snapshots to a recording. Pass it to add_snapshot_listener()."""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._file.write(json.dumps({'format': FORMAT, 'version': FORMAT_VERSION}) + '\n')
+        self._last = {}  # building_id -> {room: co2} as of the last line written
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, building_id, snapshot):
+        self.write(snapshot.fetched_at or time.time(), building_id, snapshot.co2_by_name)
+
+    def write(self, ts, building_id, levels):
+        """Append one snapshot given as {room: co2}."""
+        levels = {room: co2 for room, co2 in levels.items() if isinstance(co2, (int, float))}
+        with self._lock:
+            if self._file is None:
+                return
+            last = self._last.get(building_id, {})
+            changed = {room: co2 for room, co2 in levels.items() if last.get(room) != co2}
+            changed.update({room: None for room in last if room not in levels})
+            self._last[building_id] = levels
+            record = {'t': round(ts, 1), 'b': building_id, 'co2': changed}
+            self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self._file.flush()
+                self._flushed = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    """Yield (ts, building_id, {room: co2}) for every snapshot in a recording.
+
+    The levels dict is updated in place from one snapshot to the next; copy
+    it to keep it. A recording cut off by a crash or a recorder that is still
+    running is read up to its last complete line.
+    """
+    levels = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as recording:
+        try:
+            for line in recording:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning(f"{path} ends in a partial line; replaying up to it")
+                    return
+                if 'format' in record:
+                    if record['format'] != FORMAT or record['version'] > FORMAT_VERSION:
+                        raise ValueError(f"{path} is not a recording this version can read")
+                    levels.clear()  # every session starts from full snapshots
+                    continue
+                building = levels.setdefault(record['b'], {})
+                for room, co2 in record['co2'].items():
+                    if co2 is None:
+                        building.pop(room, None)
+                    else:
+                        building[room] = co2
+                yield record['t'], record['b'], building
+        except EOFError:
+            logging.warning(f"{path} was not closed properly; replaying what was written")
+
+
+def record(path, hours=None, building_ids=BUILDING_IDS, interval=RECORD_INTERVAL):
+    """Poll the CO2 API and record every building's snapshots until hours pass or Ctrl-C."""
+    recorder = SnapshotRecorder(path)
+    add_snapshot_listener(recorder)
+    deadline = time.monotonic() + hours * 3600 if hours else None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            for building_id in building_ids:
+                refresh_room_data(building_id)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+
+
+def export_history(path, start, end, building_id=BUILDING_ID):
+    """Write the raw CO2 history between two epoch times as a recording. Returns the snapshot count."""
+    from db import get_db
+    rows = get_db().execute(
+        'SELECT ts, room, co2 FROM co2_readings WHERE ts >= ? AND ts < ? ORDER BY ts',
+        (int(start), int(end))
+    ).fetchall()
+    recorder = SnapshotRecorder(path)
+    levels = {}
+    snapshots = 0
+    try:
+        for i, row in enumerate(rows):
+            levels[row['room']] = row['co2']
+            if i + 1 == len(rows) or rows[i + 1]['ts'] != row['ts']:
+                recorder.write(row['ts'], building_id, levels)
+                snapshots += 1
+    finally:
+        recorder.close()
+    return snapshots
+
+
+class SimulatedClock:
+    """Stands in for time.monotonic(); replay() moves it to each snapshot's time."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def replay(path, speed=DEFAULT_SPEED, rooms=None, thresholds=None, min_run_seconds=None,
+           min_idle_seconds=None, report_ppm=()):
+    """Run a recording through the automation engine and return per-room statistics.
+
+    Fans are assigned in whatever database AIRAWARE_DB points at, so use a
+    scratch one, as main() does. thresholds is (on_ppm, off_ppm) for every
+    room and the min_*_seconds override config.py's. Time above each level in
+    report_ppm is reported per room.
+    """
+    # Imported here, not at the top, so main() can point AIRAWARE_DB at a scratch database first
+    import hardware
+    from airaware import init_database
+    from automation import AutomationEngine
+    from fan_handler import apply_fan_changes, init_fan_registry
+    from inventory import add_device, load_devices
+    from locks import room_locks
+
+    init_database()
+    init_fan_registry()
+    clock = SimulatedClock()
+    engines = {}
+    fan_on = {}
+    stats = {}
+    previous = {}  # building_id -> (ts, {room: co2}) of its last snapshot
+    next_pin = hardware.FIRST_VIRTUAL_PIN
+    switches = hardware.CountingRelay.switches
+    snapshots = 0
+    first_ts = last_ts = None
+    started = time.perf_counter()
+
+    for ts, building_id, levels in read_recording(path):
+        if first_ts is None:
+            first_ts = ts
+        last_ts = ts
+        if speed:
+            ahead = (ts - first_ts) / speed - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+        levels = {room: co2 for room, co2 in levels.items() if rooms is None or room in rooms}
+
+        engine = engines.get(building_id)
+        if engine is None:
+            engine = engines[building_id] = AutomationEngine(room_locks, building_id, clock=clock)
+            if thresholds:
+                engine.default_thresholds = tuple(thresholds)
+                engine.room_thresholds = {}
+            if min_run_seconds is not None:
+                engine.min_run_seconds = min_run_seconds
+            if min_idle_seconds is not None:
+                engine.min_idle_seconds = min_idle_seconds
+
+        # The previous snapshot's levels and fan states held until now
+        if building_id in previous:
+            since, held = previous[building_id]
+            span = min(ts - since, MAX_SAMPLE_GAP)
+            for room, co2 in held.items():
+                room_stats = stats[room]
+                room_stats['seconds'] += span
+                if fan_on.get(room):
+                    room_stats['fan_seconds'] += span
+                for ppm in report_ppm:
+                    if co2 >= ppm:
+                        room_stats['above'][ppm] = room_stats['above'].get(ppm, 0) + span
+
+        new_rooms = [room for room in levels if room not in stats]
+        if new_rooms:
+            pins = range(next_pin, next_pin + len(new_rooms))
+            next_pin += len(new_rooms)
+            for room, pin in zip(new_rooms, pins):
+                add_device(pin, 'counting')
+                stats[room] = {'seconds': 0, 'fan_seconds': 0, 'toggles': 0, 'max_co2': 0, 'above': {}}
+            apply_fan_changes(assigns=new_rooms)
+            hardware.configure_devices(load_devices())
+            for pin in pins:
+                hardware.initialize_fan(pin)
+        for room, co2 in levels.items():
+            stats[room]['max_co2'] = max(stats[room]['max_co2'], co2)
+
+        clock.now = ts
+        snapshots += 1
+        snapshot = RoomSnapshot(
+            [{'roomGroupName': room, 'co2': co2} for room, co2 in levels.items()],
+            version=snapshots, fetched_at=ts
+        )
+        for room, action in engine.evaluate(snapshot).items():
+            fan_on[room] = action == 'ON'
+            stats[room]['toggles'] += 1
+        previous[building_id] = (ts, levels)
+
+    return {
+        'snapshots': snapshots,
+        'simulated_seconds': (last_ts - first_ts) if snapshots else 0,
+        'wall_seconds': time.perf_counter() - started,
+        'relay_switches': hardware.CountingRelay.switches - switches,
+        'rooms': stats,
+    }
+
+
+def print_report(result, report_ppm):
+    hours = result['simulated_seconds'] / 3600
+    speed = result['simulated_seconds'] / result['wall_seconds'] if result['wall_seconds'] else 0
+    print(f"{result['snapshots']} snapshots, {hours:.1f} h simulated in {result['wall_seconds']:.1f} s "
+          f"({speed:,.0f}x), {result['relay_switches']} relay switches")
+    header = f"{'room':<20} {'fan on h':>9} {'toggles':>8}" + ''.join(f" {'>=' + str(ppm) + ' h':>9}" for ppm in report_ppm)
+    print(header + f" {'max ppm':>8}")
+    for room, room_stats in sorted(result['rooms'].items()):
+        above = ''.join(f" {room_stats['above'].get(ppm, 0) / 3600:9.2f}" for ppm in report_ppm)
+        print(f"{room:<20} {room_stats['fan_seconds'] / 3600:9.2f} {room_stats['toggles']:8d}{above} "
+              f"{room_stats['max_co2']:8.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_args = commands.add_parser('record', help="record snapshots from the CO2 API")
+    record_args.add_argument('path')
+    record_args.add_argument('--hours', type=float, help="stop after this long (default: until Ctrl-C)")
+    export_args = commands.add_parser('export', help="build a recording from the stored CO2 history")
+    export_args.add_argument('path')
+    export_args.add_argument('--days', type=float, default=7)
+    replay_args = commands.add_parser('replay', help="replay a recording through the automation engine")
+    replay_args.add_argument('path')
+    replay_args.add_argument('--speed', type=float, default=DEFAULT_SPEED,
+                             help="times faster than real time; 0 runs as fast as possible")
+    replay_args.add_argument('--rooms', help="comma-separated rooms to simulate (default: all)")
+    replay_args.add_argument('--on-ppm', type=int, help="switch fans on at this level (default: config.py)")
+    replay_args.add_argument('--off-ppm', type=int, help="switch fans off below this level")
+    replay_args.add_argument('--min-run', type=float, help="minimum seconds a fan stays on")
+    replay_args.add_argument('--min-idle', type=float, help="minimum seconds a fan stays off")
+    replay_args.add_argument('--report-ppm', help="comma-separated levels to report time above (default: the alert levels)")
+    replay_args.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'record':
+        record(args.path, args.hours)
+        return
+    if args.command == 'export':
+        end = time.time()
+        count = export_history(args.path, end - args.days * 86400, end)
+        print(f"Wrote {count} snapshots to {args.path}")
+        return
+
+    if args.speed < 0:
+        parser.error("--speed can't be negative")
+    if (args.on_ppm is None) != (args.off_ppm is None):
+        parser.error("--on-ppm and --off-ppm go together")
+    if args.on_ppm is not None and args.off_ppm > args.on_ppm:
+        parser.error("--off-ppm must not be above --on-ppm")
+    with tempfile.TemporaryDirectory(prefix='airaware-sim-') as scratch:
+        os.environ['AIRAWARE_DB'] = os.path.join(scratch, 'airaware.db')
+        os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+        from app import CO2_HIGH_THRESHOLD, CO2_VERY_HIGH_THRESHOLD
+        from config import AUTOMATION_ON_PPM
+        if args.report_ppm:
+            report_ppm = [int(ppm) for ppm in args.report_ppm.split(',')]
+        else:
+            report_ppm = [CO2_HIGH_THRESHOLD, CO2_VERY_HIGH_THRESHOLD]
+        report_ppm = sorted({args.on_ppm or AUTOMATION_ON_PPM, *report_ppm})
+        result = replay(
+            args.path, args.speed,
+            rooms=set(args.rooms.split(',')) if args.rooms else None,
+            thresholds=(args.on_ppm, args.off_ppm) if args.on_ppm is not None else None,
+            min_run_seconds=args.min_run, min_idle_seconds=args.min_idle,
+            report_ppm=report_ppm
+        )
+    print_report(result, report_ppm)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'results': result}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -46,10 +46,29 @@ function revertFanSwitch(room, state) {
     document.getElementById(`switch-${room}`).checked = state;
 }
 
+// ETags of the last response per URL. Polls send them back, and a 304 means
+// nothing changed, so there is nothing to parse or redraw.
+const pollETags = {};
+
+async function fetchIfChanged(url) {
+    const headers = pollETags[url] ? { 'If-None-Match': pollETags[url] } : {};
+    const response = await fetch(url, { headers, cache: 'no-store' });
+    if (response.status === 304) {
+        return null;
+    }
+    if (!response.ok) {
+        throw new Error(`${url} returned ${response.status}`);
+    }
+    const etag = response.headers.get('ETag');
+    if (etag) {
+        pollETags[url] = etag;
+    }
+    return response.json();
+}
+
 function updateCO2Levels() {
-    fetch('/api/get_co2_levels')
-        .then(response => response.json())
-        .then(data => updateCO2Display(data))
+    fetchIfChanged('/api/get_co2_levels')
+        .then(data => data && updateCO2Display(data))
         .catch(error => console.error("Error fetching CO₂ levels:", error));
 }
 
@@ -75,9 +94,8 @@ function getCO2Class(co2Level) {
 }
 
 function updateFanStatusPeriodically() {
-    fetch('/api/fan_status')
-        .then(response => response.json())
-        .then(data => updateFanDisplays(data))
+    fetchIfChanged('/api/fan_status')
+        .then(data => data && updateFanDisplays(data))
         .catch(error => console.error("Error fetching fan status:", error));
 }
 
@@ -136,9 +154,10 @@ function handleRemoveFanResponse(data, room) {
 
 async function updateAvailableRooms() {
     try {
-        const response = await fetch('/api/available_rooms');
-        const availableRooms = await response.json();
-        updateRoomSelect(availableRooms);
+        const availableRooms = await fetchIfChanged('/api/available_rooms');
+        if (availableRooms) {
+            updateRoomSelect(availableRooms);
+        }
     } catch (error) {
         console.error("Error updating available rooms:", error);
     }
@@ -244,8 +263,38 @@ function initializePolling() {
     updateFanStatusPeriodically();
 }
 
+function initializeUpdates() {
+    if (!window.EventSource) {
+        initializePolling();
+        return;
+    }
+
+    // The server pushes the full state on connect and only changes after that
+    const stream = new EventSource('/api/stream');
+    let building = null;
+
+    stream.addEventListener('fans', event => updateFanDisplays(JSON.parse(event.data)));
+    stream.addEventListener('fan', event => updateFanDisplays([JSON.parse(event.data)]));
+    stream.addEventListener('co2', event => {
+        const data = JSON.parse(event.data);
+        if (building === null) {
+            building = data.building;
+        }
+        if (data.building === building) {
+            updateCO2Display(data.rooms);
+        }
+    });
+    stream.onerror = () => {
+        // EventSource reconnects on its own unless the server refused the stream
+        if (stream.readyState === EventSource.CLOSED) {
+            console.error("Event stream closed, falling back to polling");
+            initializePolling();
+        }
+    };
+}
+
 window.handleFanControl = handleFanControl;
 window.removeFan = removeFan;
 window.handleAssignFan = handleAssignFan;
 
-document.addEventListener('DOMContentLoaded', initializePolling);
\ No newline at end of file
+document.addEventListener('DOMContentLoaded', initializeUpdates);
\ No newline at end of file
@@ -0,0 +1,17 @@
+"""WSGI entry point for production serving.
+
+    gunicorn --workers 4 --worker-class gthread --threads 64 --bind 0.0.0.0:5000 wsgi:app
+
+gthread workers are needed because every open dashboard holds one thread for
+its /api/stream connection for as long as the page is open. Size --threads so
+that each worker can hold its share of the dashboards and still serve page
+loads, POSTs and the polling fallback: with 100 dashboards spread over 4 x 64
+threads, more than half of each worker stays free, which leaves room for
+streams landing unevenly. An idle stream thread costs little memory, so err
+on the high side. Don't pass --preload: create_app() must run in each
+worker so that leader election happens after the fork.
+"""
+from app import configure_logging, create_app
+
+configure_logging()
+app = create_app()